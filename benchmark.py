@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+import numpy as np, torch, os, gc, time, sys, json, wave, tempfile, argparse, subprocess
+try:
+  import resource
+except ImportError:  # Windows
+  resource = None
+from silicbat import LABEL_COLUMNS, AudioStandarize, SilicBat, clean_multi_boxes, profiler
+
+SPECT_TYPES = ['linear', 'mel', 'rainbow']
+STAGES = ['AudioStandarize'] + ['tfr.%s' %spect_type for spect_type in SPECT_TYPES] + ['detect', 'clean_multi_boxes']
+
+def synthetic_labels(n, classes=(498, 500, 520, 521), seed=0):
+  """
+  Label table shaped like the output of SilicBat.detect: echolocation pulses every ~60 ms, each
+  detected by one to three overlapping clips with slightly jittered boxes.
+  """
+  rng = np.random.default_rng(seed)
+  labels = [list(LABEL_COLUMNS)]
+  t = 0
+  while len(labels) <= n:
+    t += int(rng.integers(20, 100))
+    classid = int(rng.choice(classes))
+    length = int(rng.integers(5, 20))
+    fl = int(rng.integers(20000, 60000))
+    fh = fl + int(rng.integers(5000, 40000))
+    for _ in range(int(rng.integers(1, 4))):
+      ts = t + int(rng.integers(-3, 4))
+      labels.append(['sample.wav', classid, '', '', '', ts, ts + length + int(rng.integers(-2, 3)), fl + int(rng.integers(-2000, 2000)), fh + int(rng.integers(-2000, 2000)), round(float(rng.random()), 3)])
+  return labels[:n+1]
+
+def benchmark_clean_multi_boxes(sizes=(1000, 10000, 100000), reference_limit=10000):
+  # the python engine is O(n^2), so it only runs up to reference_limit boxes
+  print('boxes\tnumpy (s)\tpython (s)\tspeedup\tidentical')
+  for n in sizes:
+    labels = synthetic_labels(n)
+    t0 = time.time()
+    fast = clean_multi_boxes(labels, engine='numpy')
+    t_fast = time.time()-t0
+    if n <= reference_limit:
+      t0 = time.time()
+      slow = clean_multi_boxes(labels, engine='python')
+      t_slow = time.time()-t0
+      print('%s\t%.3f\t%.3f\t%.1fx\t%s' %(n, t_fast, t_slow, t_slow/t_fast, fast.equals(slow)))
+    else:
+      print('%s\t%.3f\t-\t-\t-' %(n, t_fast))
+
+def synthetic_recording(audio_file, sr=384000, duration=10, seed=0):
+  """
+  16-bit mono WAV of bat-like calls over background noise: passes of FM sweeps (e.g. Myotis,
+  Pipistrellus) and long CF calls with an FM tail (e.g. Rhinolophus, Hipposideros).
+  """
+  rng = np.random.default_rng(seed)
+  n = int(sr*duration)
+  data = rng.normal(0, 0.01, n)
+  t = 0.05
+  while t < duration - 0.1:
+    if rng.random() < 0.7:
+      # downward FM sweep, 2-6 ms
+      length = rng.uniform(0.002, 0.006)
+      f0, f1 = rng.uniform(60000, 110000), rng.uniform(25000, 50000)
+    else:
+      # constant frequency call, 20-50 ms, ending in a short FM tail
+      length = rng.uniform(0.02, 0.05)
+      f0 = rng.uniform(40000, min(110000, sr*0.4))
+      f1 = f0*0.8
+    f0, f1 = min(f0, sr*0.45), min(f1, sr*0.45)
+    tt = np.arange(int(length*sr))/sr
+    if f0 == f1 or length < 0.01:
+      freq = f0 + (f1-f0)*tt/length
+    else:
+      freq = np.where(tt < length*0.85, f0, f0 + (f1-f0)*(tt-length*0.85)/(length*0.15))
+    call = np.sin(2*np.pi*np.cumsum(freq)/sr)*np.hanning(tt.size)*rng.uniform(0.1, 0.8)
+    start = int(t*sr)
+    data[start:start+call.size] += call[:n-start]
+    t += length + rng.uniform(0.05, 0.15)
+  with wave.open(audio_file, 'wb') as f:
+    f.setnchannels(1)
+    f.setsampwidth(2)
+    f.setframerate(sr)
+    f.writeframes((np.clip(data, -1, 1)*32767).astype('<i2').tobytes())
+  return audio_file
+
+def timed(results, name, duration, func, *args, repeat=3, warmup=1, setup=None, **kwargs):
+  """
+  Best of repeat timed runs of func after warmup untimed ones, calling setup (untimed) before
+  every run, e.g. to drop cached spectrograms.
+  """
+  for _ in range(warmup):
+    if setup:
+      setup()
+    func(*args, **kwargs)
+  times = []
+  for _ in range(max(1, repeat)):
+    if setup:
+      setup()
+    t0 = time.perf_counter()
+    output = func(*args, **kwargs)
+    times.append(time.perf_counter()-t0)
+  seconds = min(times)
+  results[name] = {'seconds':seconds, 'repeats':len(times), 'audio_seconds_per_wall_second':duration/seconds if seconds else None}
+  print('%s\t%.3f s\t%.1f x realtime' %(name, seconds, duration/seconds if seconds else float('inf')))
+  return output
+
+def max_rss():
+  # peak resident set size of this process in bytes. On Linux VmHWM, as ru_maxrss also keeps the
+  # peak at the exit of any thread, which reset_max_rss does not clear
+  try:
+    with open('/proc/self/status') as f:
+      for line in f:
+        if line.startswith('VmHWM:'):
+          return int(line.split()[1])*1024
+  except OSError:
+    pass
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*(1 if sys.platform == 'darwin' else 1024)
+
+def reset_max_rss():
+  # restart the peak from the current resident set size (Linux), elsewhere it keeps the peak of the setup
+  try:
+    with open('/proc/self/clear_refs', 'w') as f:
+      f.write('5')
+  except OSError:
+    pass
+
+def run_stage(stage, audio_file, weights, workdir, labels_file=None):
+  """
+  Run one stage of benchmark_pipeline once in this process, after loading the audio, model or labels
+  it needs, and return the peak resident set size during the stage in bytes. Unlike tracemalloc this
+  counts torch tensors and OpenCV buffers as well.
+  """
+  gc.collect()
+  if stage == 'AudioStandarize':
+    reset_max_rss()
+    AudioStandarize(audio_file, device='cpu', high_pass=16000)
+    return max_rss()
+  if stage == 'clean_multi_boxes':
+    with open(labels_file) as f:
+      labels = json.load(f)
+    gc.collect()
+    reset_max_rss()
+    clean_multi_boxes(labels)
+    return max_rss()
+  model = SilicBat(device='cpu')
+  model.audio(audio_file)
+  name = os.path.splitext(os.path.basename(audio_file))[0]
+  if stage == 'detect':
+    model.load_model(weights)
+    gc.collect()
+    reset_max_rss()
+    model.detect(weights, targetfilepath=os.path.join(workdir, 'rainbow_%s.png' %name))
+  else:
+    spect_type = stage.split('.')[1]
+    gc.collect()
+    reset_max_rss()
+    model.tfr(targetfilepath=os.path.join(workdir, '%s_%s.png' %(spect_type, name)), spect_type=spect_type)
+  return max_rss()
+
+def stage_memory(results, stage, audio_file, weights, workdir, labels_file=None):
+  # run_stage in a fresh Python process, so memory freed by earlier stages does not hide the peak
+  if resource is None:
+    return None
+  command = [sys.executable, os.path.abspath(__file__), 'memory', stage, audio_file, '--weights', os.path.abspath(weights), '--workdir', workdir]
+  if labels_file:
+    command += ['--labels', labels_file]
+  output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+  peak_rss = json.loads(output.strip().splitlines()[-1])['peak_rss']
+  results[stage]['peak_rss'] = peak_rss
+  print('%s\t%.1f MB peak' %(stage, peak_rss/1024**2))
+  return peak_rss
+
+def calibrate(repeat=5):
+  # best time of a fixed FFT and convolution workload, a measure of the current speed of the machine
+  rng = np.random.default_rng(0)
+  signal = rng.normal(size=2**20).astype(np.float32)
+  img = torch.from_numpy(rng.normal(size=(4, 3, 256, 256)).astype(np.float32))
+  kernel = torch.from_numpy(rng.normal(size=(32, 3, 3, 3)).astype(np.float32))
+  times = []
+  for _ in range(repeat):
+    t0 = time.perf_counter()
+    np.fft.rfft(signal.reshape(-1, 1024), axis=1)
+    with torch.no_grad():
+      torch.nn.functional.conv2d(img, kernel)
+    times.append(time.perf_counter()-t0)
+  return min(times)
+
+def benchmark_pipeline(sample_rates=(250000, 384000, 500000), durations=(5, 20), weights='model/exp/best.pt', workdir=None, repeat=3, warmup=1):
+  """
+  Time AudioStandarize, SilicBat.tfr for every spect_type, detect and clean_multi_boxes on CPU
+  for each synthetic recording, see timed, and measure the peak memory of each, see stage_memory.
+  Results are keyed '<sample rate>/<duration>/<stage>'.
+  """
+  if not workdir:
+    workdir = tempfile.mkdtemp(prefix='silic_benchmark_')
+  results = {}
+  calibration = calibrate()
+  for sr in sample_rates:
+    for duration in durations:
+      audio_file = synthetic_recording(os.path.join(workdir, 'synthetic_%s_%s.wav' %(sr, duration)), sr=sr, duration=duration)
+      print('== %s Hz, %s s ==' %(sr, duration))
+      case = {}
+      timed(case, 'AudioStandarize', duration, AudioStandarize, audio_file, device='cpu', high_pass=16000, repeat=repeat, warmup=warmup)
+      model = SilicBat(device='cpu')
+      model.audio(audio_file)
+      for spect_type in SPECT_TYPES:
+        timed(case, 'tfr.%s' %spect_type, duration, model.tfr, targetfilepath=os.path.join(workdir, '%s_%s_%s.png' %(spect_type, sr, duration)), spect_type=spect_type, repeat=repeat, warmup=warmup, setup=model.free_spectrograms)
+      model.load_model(weights)
+      labels = timed(case, 'detect', duration, model.detect, weights, targetfilepath=os.path.join(workdir, 'rainbow_%s_%s.png' %(sr, duration)), repeat=repeat, warmup=warmup, setup=model.free_spectrograms)
+      timed(case, 'clean_multi_boxes', duration, clean_multi_boxes, labels, repeat=repeat, warmup=warmup)
+      labels_file = os.path.join(workdir, 'labels_%s_%s.json' %(sr, duration))
+      with open(labels_file, 'w') as f:
+        json.dump(labels, f)
+      for stage in STAGES:
+        stage_memory(case, stage, audio_file, weights, workdir, labels_file)
+      for stage, result in case.items():
+        results['%s/%s/%s' %(sr, duration, stage)] = result
+  # the faster of the calibrations before and after, as the machine may slow down in between
+  results['calibration'] = {'seconds':min(calibration, calibrate())}
+  return results
+
+def match_labels(reference, labels, min_iou=0.5):
+  # fraction of the reference boxes overlapping a box of the same class in labels by min_iou
+  if not len(reference):
+    return 1.0
+  if not len(labels):
+    return 0.0
+  a = reference[['time_begin', 'time_end', 'freq_low', 'freq_high']].to_numpy(float)[:, None]
+  b = labels[['time_begin', 'time_end', 'freq_low', 'freq_high']].to_numpy(float)[None]
+  inter = np.clip(np.minimum(a[..., 1], b[..., 1]) - np.maximum(a[..., 0], b[..., 0]), 0, None)*np.clip(np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 2], b[..., 2]), 0, None)
+  union = (a[..., 1]-a[..., 0])*(a[..., 3]-a[..., 2]) + (b[..., 1]-b[..., 0])*(b[..., 3]-b[..., 2]) - inter
+  iou = np.where(union > 0, inter/np.where(union > 0, union, 1), 0)
+  same_class = reference['classid'].to_numpy()[:, None] == labels['classid'].to_numpy()[None]
+  return float(((iou >= min_iou) & same_class).any(axis=1).mean())
+
+def benchmark_backends(backends=('eager', 'torchscript'), audio_file='sample/sample01.wav', weights='model/exp/best.pt', quantize=False, threads=None, repeat=3):
+  """
+  Run detection on audio_file with each inference backend (exporting it on first use). Reports the
+  best forward and detect_clips times of repeat runs and the parity of the cleaned labels with the
+  eager model: the fraction of eager boxes found by the backend (recall) and the other way round.
+  """
+  results = {}
+  reference = None
+  print('backend\tforward (s)\tdetect (s)\tspeedup\tboxes\trecall\tprecision')
+  for backend in ['eager'] + [b for b in backends if b != 'eager']:
+    model = SilicBat(device='cpu', inference_backend=backend, quantize=quantize, threads=threads)
+    model.audio(audio_file)
+    model.detect(weights, targetfilepath=os.path.join(tempfile.gettempdir(), 'silic_backend_rainbow.png'))
+    forward, seconds = [], []
+    for _ in range(repeat):
+      profiler.enable()
+      t0 = time.perf_counter()
+      labels = model.detect_clips()
+      seconds.append(time.perf_counter()-t0)
+      forward.append(profiler.stages['forward'][1])
+      profiler.disable()
+    labels = clean_multi_boxes(labels)
+    if reference is None:
+      reference = labels
+    result = {'forward_seconds':min(forward), 'seconds':min(seconds), 'boxes':len(labels), 'recall':match_labels(reference, labels), 'precision':match_labels(labels, reference)}
+    result['speedup'] = results['eager']['forward_seconds']/result['forward_seconds'] if 'eager' in results else 1.0
+    results[backend] = result
+    print('%s\t%.3f\t%.3f\t%.2fx\t%s\t%.3f\t%.3f' %(backend, result['forward_seconds'], result['seconds'], result['speedup'], result['boxes'], result['recall'], result['precision']))
+  return results
+
+def check_baseline(results, baseline, tolerance=0.25, floor=0.05, memory_tolerance=0.1):
+  """
+  Stages slower than the baseline by more than tolerance and by more than floor seconds, so
+  jitter of short stages is not flagged, as [name, 'seconds', baseline seconds, seconds]. The
+  baseline is first scaled by the ratio of the calibrations, so a machine that is slower as a
+  whole than when the baseline was taken does not fail every stage. Stages whose peak memory
+  grew by more than memory_tolerance are listed as [name, 'peak_rss', baseline bytes, bytes].
+  """
+  scale = 1.0
+  if 'calibration' in results and 'calibration' in baseline:
+    scale = results['calibration']['seconds']/baseline['calibration']['seconds']
+  regressions = []
+  for name, result in results.items():
+    if name == 'calibration' or name not in baseline:
+      continue
+    expected = baseline[name]['seconds']*scale
+    if result['seconds'] > expected*(1+tolerance) and result['seconds'] - expected > floor:
+      regressions.append([name, 'seconds', expected, result['seconds']])
+    if result.get('peak_rss') and baseline[name].get('peak_rss') and result['peak_rss'] > baseline[name]['peak_rss']*(1+memory_tolerance):
+      regressions.append([name, 'peak_rss', baseline[name]['peak_rss'], result['peak_rss']])
+  return regressions
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Offline benchmarks of the SILIC pipeline')
+  subparsers = parser.add_subparsers(dest='command')
+  clean_parser = subparsers.add_parser('clean', help='clean_multi_boxes engines on synthetic label tables')
+  clean_parser.add_argument('sizes', nargs='*', type=int, default=[1000, 10000, 100000])
+  pipeline_parser = subparsers.add_parser('pipeline', help='every stage on synthetic ultrasonic recordings')
+  pipeline_parser.add_argument('--sample-rates', nargs='+', type=int, default=[250000, 384000, 500000])
+  pipeline_parser.add_argument('--durations', nargs='+', type=float, default=[5, 20])
+  pipeline_parser.add_argument('--weights', default='model/exp/best.pt')
+  pipeline_parser.add_argument('--output', default=None, help='save the results as JSON')
+  pipeline_parser.add_argument('--baseline', default='benchmark_baseline.json')
+  pipeline_parser.add_argument('--tolerance', type=float, default=0.25)
+  pipeline_parser.add_argument('--floor', type=float, default=0.05, help='seconds a stage may slow down regardless of tolerance')
+  pipeline_parser.add_argument('--memory-tolerance', type=float, default=0.1, help='fraction the peak memory of a stage may grow')
+  pipeline_parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage, the fastest counts')
+  pipeline_parser.add_argument('--warmup', type=int, default=1)
+  pipeline_parser.add_argument('--update-baseline', action='store_true')
+  backend_parser = subparsers.add_parser('backend', help='latency and label parity of the CPU inference backends against the eager model')
+  backend_parser.add_argument('backends', nargs='*', default=['torchscript'], help='torchscript and/or onnx')
+  backend_parser.add_argument('--audio', default='sample/sample01.wav')
+  backend_parser.add_argument('--weights', default='model/exp/best.pt')
+  backend_parser.add_argument('--quantize', action='store_true', help='dynamic int8 quantization (onnx)')
+  backend_parser.add_argument('--threads', type=int, default=None)
+  backend_parser.add_argument('--repeat', type=int, default=3)
+  backend_parser.add_argument('--min-parity', type=float, default=0.95, help='fail below this recall or precision')
+  memory_parser = subparsers.add_parser('memory', help='peak memory of one pipeline stage, run by the pipeline benchmark')
+  memory_parser.add_argument('stage', choices=STAGES)
+  memory_parser.add_argument('audio')
+  memory_parser.add_argument('--weights', default='model/exp/best.pt')
+  memory_parser.add_argument('--workdir', default=tempfile.gettempdir())
+  memory_parser.add_argument('--labels', default=None, help='JSON label table for clean_multi_boxes')
+  args = parser.parse_args()
+  if args.command == 'memory':
+    print(json.dumps({'peak_rss':run_stage(args.stage, args.audio, args.weights, args.workdir, args.labels)}))
+  elif args.command == 'backend':
+    results = benchmark_backends(args.backends, args.audio, args.weights, args.quantize, args.threads, args.repeat)
+    failed = [backend for backend, result in results.items() if min(result['recall'], result['precision']) < args.min_parity]
+    for backend in failed:
+      print('Parity check failed: %s' %backend)
+    if failed:
+      sys.exit(1)
+  elif args.command == 'pipeline':
+    results = benchmark_pipeline(args.sample_rates, args.durations, args.weights, repeat=args.repeat, warmup=args.warmup)
+    if args.output:
+      with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    if args.update_baseline or not os.path.exists(args.baseline):
+      with open(args.baseline, 'w') as f:
+        json.dump(results, f, indent=2)
+      print('Baseline was saved to %s.' %args.baseline)
+    else:
+      with open(args.baseline) as f:
+        regressions = check_baseline(results, json.load(f), args.tolerance, args.floor, args.memory_tolerance)
+      for name, measure, before, after in regressions:
+        if measure == 'peak_rss':
+          print('Regression: %s expected a peak of %.1f MB, used %.1f MB' %(name, before/1024**2, after/1024**2))
+        else:
+          print('Regression: %s expected %.3f s, took %.3f s' %(name, before, after))
+      if regressions:
+        sys.exit(1)
+      print('No regressions against %s.' %args.baseline)
+  else:
+    benchmark_clean_multi_boxes(sizes=args.sizes if args.command == 'clean' else (1000, 10000, 100000))
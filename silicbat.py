@@ -1,14 +1,113 @@
 # -*- coding: utf-8 -*-
-import numpy as np, pandas as pd, torch, cv2, os, time, shutil, sys
+import numpy as np, pandas as pd, torch, cv2, os, time, shutil, sys, wave, subprocess, multiprocessing, hashlib, json, threading, math, inspect, platform, zipfile, queue, collections
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import matplotlib.pyplot as plt
 from matplotlib.colors import ListedColormap
 from matplotlib import cm
 from pydub import AudioSegment, effects, scipy_effects
+from pydub.utils import mediainfo, db_to_float
+from scipy.signal import butter, sosfilt, resample_poly
 from nnAudio import Spectrogram
+from torch.nn.functional import conv1d
 from yolov5.models.experimental import attempt_load
+from yolov5.models.yolo import Detect
 from yolov5.utils.datasets import letterbox
 from yolov5.utils.general import non_max_suppression, scale_coords, xyxy2xywh
 from PIL import ImageFont, ImageDraw, Image
+try:
+  import resource
+except ImportError:  # Windows
+  resource = None
+try:
+  import soundfile
+except ImportError:
+  soundfile = None
+try:
+  import onnxruntime
+  from onnxruntime.quantization import quantize_dynamic, QuantType
+except ImportError:
+  onnxruntime = None
+
+AUDIO_EXTENSIONS = ['mp3', 'wma', 'm4a', 'ogg', 'wav', 'mp4', 'wma', 'aac', 'flac']
+NATIVE_EXTENSIONS = ['wav', 'flac']
+LABEL_COLUMNS = ['file', 'classid', 'species_name', 'sound_class', 'scientific_name', "time_begin", "time_end", "freq_low", "freq_high", "score"]
+
+class Profiler:
+  """
+  Opt-in stage timers and counters for the detection pipeline. While disabled, stage() and count()
+  do nothing; enable() starts a run and report() writes a JSON (or CSV, by extension) summary with
+  the wall time per stage, audio seconds per wall second and peak RSS. Stages that run in the
+  decode worker processes of batch_detect are not included.
+  """
+  def __init__(self):
+    self.enabled = False
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    self.stages = {}
+    self.counters = {}
+    self.t0 = time.time()
+
+  def enable(self):
+    self.reset()
+    self.enabled = True
+
+  def disable(self):
+    self.enabled = False
+
+  @contextmanager
+  def stage(self, name):
+    if not self.enabled:
+      yield
+      return
+    t = time.perf_counter()
+    try:
+      yield
+    finally:
+      if torch.cuda.is_available():
+        torch.cuda.synchronize()
+      elapsed = time.perf_counter() - t
+      with self.lock:
+        calls, seconds = self.stages.get(name, (0, 0.0))
+        self.stages[name] = (calls + 1, seconds + elapsed)
+
+  def count(self, name, n=1):
+    if self.enabled:
+      with self.lock:
+        self.counters[name] = self.counters.get(name, 0) + n
+
+  def peak_rss(self):
+    # peak resident set size of this process in bytes, None where unavailable
+    if resource is None:
+      return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss*1024
+
+  def summary(self, **info):
+    wall = time.time() - self.t0
+    audio_seconds = self.counters.get('audio_seconds', 0)
+    windows = self.counters.get('windows', 0)
+    return {'info':info, 'started':time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.t0)), 'python':platform.python_version(), 'torch':torch.__version__,
+            'wall_seconds':wall, 'audio_seconds':audio_seconds, 'audio_seconds_per_wall_second':audio_seconds/wall if wall else None, 'peak_rss':self.peak_rss(),
+            'windows_skipped_fraction':self.counters.get('windows_skipped', 0)/windows if windows else None,
+            'stages':{name:{'calls':calls, 'seconds':seconds} for name, (calls, seconds) in self.stages.items()}, 'counters':dict(self.counters)}
+
+  def report(self, path, **info):
+    summary = self.summary(**info)
+    if path.lower().endswith('.csv'):
+      rows = [[name, stage['calls'], stage['seconds']] for name, stage in summary['stages'].items()]
+      rows += [[name, '', value] for name, value in summary['counters'].items()]
+      rows += [[name, '', summary[name]] for name in ['wall_seconds', 'audio_seconds_per_wall_second', 'peak_rss', 'windows_skipped_fraction']]
+      pd.DataFrame(rows, columns=['name', 'calls', 'value']).to_csv(path, index=False)
+    else:
+      with open(path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=2, ensure_ascii=False)
+    print('Profile was saved to %s.' %path)
+    return summary
+
+profiler = Profiler()
 
 def speed_change(sound, speed=1.0):
     # Manually override the frame_rate. This tells the computer how many
@@ -22,49 +121,477 @@ def speed_change(sound, speed=1.0):
     print(sound_with_altered_frame_rate.frame_rate)
     return sound_with_altered_frame_rate.set_frame_rate(int(sound.frame_rate*speed))
 
-def AudioStandarize(audio_file, sr=320000, device=None, high_pass=0, ultrasonic=False):
+def wav_memmap(audio_file):
+  """
+  Memory-map the samples of a PCM or float WAV file as a (frames, channels) array.
+  Returns (frame_rate, samples, sample_width), or None for formats that need a decoder.
+  """
+  with open(audio_file, 'rb') as f:
+    header = f.read(12)
+    if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+      return None
+    fmt = None
+    while True:
+      chunk = f.read(8)
+      if len(chunk) < 8:
+        return None
+      chunk_id, chunk_size = chunk[:4], int.from_bytes(chunk[4:], 'little')
+      if chunk_id == b'fmt ':
+        fmt = f.read(chunk_size)
+        f.seek(chunk_size % 2, 1)
+      elif chunk_id == b'data':
+        offset = f.tell()
+        data_size = chunk_size
+        break
+      else:
+        f.seek(chunk_size + chunk_size % 2, 1)
+  if not fmt:
+    return None
+  format_tag, channels, frame_rate = int.from_bytes(fmt[0:2], 'little'), int.from_bytes(fmt[2:4], 'little'), int.from_bytes(fmt[4:8], 'little')
+  sample_width = int.from_bytes(fmt[14:16], 'little')//8
+  if format_tag == 0xFFFE and len(fmt) >= 26:  # WAVE_FORMAT_EXTENSIBLE, the sub format holds the tag
+    format_tag = int.from_bytes(fmt[24:26], 'little')
+  if format_tag == 1 and sample_width in [1, 2, 3, 4]:
+    dtype = {1:np.uint8, 2:'<i2', 3:np.uint8, 4:'<i4'}[sample_width]
+  elif format_tag == 3 and sample_width in [4, 8]:
+    dtype = {4:'<f4', 8:'<f8'}[sample_width]
+  else:
+    return None
+  # chunks such as GUANO metadata or LIST may follow the samples, so the data chunk size limits
+  # them; recorders that were stopped abruptly leave it 0 or 0xFFFFFFFF, then the file size does
+  data_size = os.path.getsize(audio_file) - offset if data_size in [0, 0xFFFFFFFF] else min(data_size, os.path.getsize(audio_file) - offset)
+  frames = data_size//(sample_width*channels)
+  count = frames*channels*(3 if sample_width == 3 else 1)
+  samples = np.memmap(audio_file, dtype=dtype, mode='r', offset=offset, shape=(count,))
+  return frame_rate, samples.reshape(frames, -1), sample_width
+
+def read_native(audio_file, channel=0):
+  # (frame_rate, channels, float32 samples of one channel in the 16-bit range), or None if the file cannot be read natively
+  filext = audio_file.split('.')[-1].lower()
+  if filext == 'wav':
+    mapped = wav_memmap(audio_file)
+    if mapped is None:
+      return None
+    frame_rate, samples, sample_width = mapped
+    if sample_width == 3:
+      channels = samples.shape[1]//3
+      data = samples.reshape(-1, channels, 3)[:, channel].astype(np.int32)
+      data = ((data[:, 0] | (data[:, 1] << 8) | (data[:, 2] << 16)) << 8 >> 8).astype(np.float32)/256
+    else:
+      channels = samples.shape[1]
+      data = samples[:, channel]
+      if samples.dtype.kind == 'f':
+        data = data.astype(np.float32)*32768
+      elif sample_width == 1:
+        data = (data.astype(np.float32) - 128)*256
+      else:
+        data = data.astype(np.float32)*2.0**(16 - sample_width*8)
+    return frame_rate, channels, data
+  if filext == 'flac' and soundfile is not None:
+    try:
+      data, frame_rate = soundfile.read(audio_file, dtype='float32', always_2d=True)
+    except RuntimeError:
+      return None
+    return frame_rate, data.shape[1], data[:, channel]*32768
+  return None
+
+def AudioStandarizeNative(audio_file, sr=320000, device=None, high_pass=0, ultrasonic=False, channel=0):
+  """
+  AudioStandarize for WAV (and FLAC, if soundfile is installed) without pydub: the samples are
+  memory-mapped, one channel is filtered and resampled with scipy and the peak is normalized to
+  -0.1 dBFS like effects.normalize. The standarized sound is None; save_standarized builds it on demand.
+  Returns None when the file has to be decoded by pydub instead.
+  """
   if not device:
     device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
-  filext = audio_file[-3:].lower()
-  if filext == "mp3":
-      sound = AudioSegment.from_mp3(audio_file)
-  elif filext == "wma":
-      sound = AudioSegment.from_file(audio_file, "wma")
-  elif filext == "m4a":
-      sound = AudioSegment.from_file(audio_file, "m4a")
-  elif filext == "ogg":
-      sound = AudioSegment.from_ogg(audio_file)
-  elif filext == "wav":
-      sound = AudioSegment.from_wav(audio_file)
-  elif filext in ["mp4", "wma", "aac"]:
-      sound = AudioSegment.from_file(audio_file, filext)
-  else:
-    print('Sorry, this file type is not permitted. The legal extensions are: wav, mp3, wma, m4a, ogg.')
+  with profiler.stage('audio.decode'):
+    native = read_native(audio_file, channel)
+  if native is None:
     return None
+  frame_rate, channels, data = native
+  original_metadata = {'channel': channels, 'sample_rate':frame_rate, 'sample_size':data.shape[0]*channels, 'duration':data.shape[0]/frame_rate}
+  print('Origional audio: channel = %s, sample_rate = %s Hz, sample_size = %s, duration = %s s' %(original_metadata['channel'], original_metadata['sample_rate'], original_metadata['sample_size'], original_metadata['duration']))
+  profiler.count('audio_seconds', original_metadata['duration'])
+  if ultrasonic:
+    if frame_rate > 100000: # UltraSonic, played back 10 times slower
+      frame_rate = int(frame_rate/10)
+    else:
+      return False
+  with profiler.stage('audio.filter'):
+    if frame_rate > sr:
+      data = sosfilt(butter(5, (sr/2)/(0.5*frame_rate), btype='lowpass', output='sos'), data).astype(np.float32)
+  with profiler.stage('audio.resample'):
+    if frame_rate != sr:
+      g = np.gcd(int(frame_rate), int(sr))
+      data = resample_poly(data, sr//g, int(frame_rate)//g).astype(np.float32)
+  with profiler.stage('audio.filter'):
+    if high_pass:
+      data = sosfilt(butter(5, high_pass/(0.5*sr), btype='highpass', output='sos'), data).astype(np.float32)
+  with profiler.stage('audio.normalize'):
+    peak = np.abs(data).max() if data.shape[0] else 0
+    if peak:
+      data *= 32768*db_to_float(-0.1)/peak
+    duration = round(data.shape[0]/sr*1000) #ms
+    audiodata = torch.from_numpy(np.ascontiguousarray(data)).to(device)
+  print('Standarized audio: channel = %s, sample_rate = %s Hz, sample_size = %s, duration = %s s' %(1, sr, data.shape[0], data.shape[0]/sr))
+  return sr, audiodata, duration, None, original_metadata
+
+def AudioStandarize(audio_file, sr=320000, device=None, high_pass=0, ultrasonic=False, backend='pydub'):
+  if not device:
+    device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+  if backend == 'native' and audio_file.split('.')[-1].lower() in NATIVE_EXTENSIONS:
+    result = AudioStandarizeNative(audio_file, sr, device, high_pass=high_pass, ultrasonic=ultrasonic)
+    if result is not None:
+      return result
+  with profiler.stage('audio.decode'):
+    filext = audio_file[-3:].lower()
+    if filext == "mp3":
+        sound = AudioSegment.from_mp3(audio_file)
+    elif filext == "wma":
+        sound = AudioSegment.from_file(audio_file, "wma")
+    elif filext == "m4a":
+        sound = AudioSegment.from_file(audio_file, "m4a")
+    elif filext == "ogg":
+        sound = AudioSegment.from_ogg(audio_file)
+    elif filext == "wav":
+        sound = AudioSegment.from_wav(audio_file)
+    elif filext in ["mp4", "wma", "aac"]:
+        sound = AudioSegment.from_file(audio_file, filext)
+    elif audio_file[-4:].lower() == "flac":
+        sound = AudioSegment.from_file(audio_file, "flac")
+    else:
+      print('Sorry, this file type is not permitted. The legal extensions are: wav, mp3, wma, m4a, ogg.')
+      return None
   original_metadata = {'channel': sound.channels, 'sample_rate':sound.frame_rate, 'sample_size':len(sound.get_array_of_samples()), 'duration':sound.duration_seconds}
   print('Origional audio: channel = %s, sample_rate = %s Hz, sample_size = %s, duration = %s s' %(original_metadata['channel'], original_metadata['sample_rate'], original_metadata['sample_size'], original_metadata['duration']))
+  profiler.count('audio_seconds', original_metadata['duration'])
   if ultrasonic:
       if sound.frame_rate > 100000: # UltraSonic
           sound = speed_change(sound, 1/10)
       else:
           return False
-  if sound.frame_rate > sr:
-      sound = scipy_effects.low_pass_filter(sound, sr/2)
-  if sound.frame_rate != sr:
-      sound = sound.set_frame_rate(sr)
-  if sound.channels > 1:
-      sound = sound.split_to_mono()[0]
-  if not sound.sample_width == 2:
-      sound = sound.set_sample_width(2)
-  if high_pass:
-    sound = sound.high_pass_filter(high_pass)
-  sound = effects.normalize(sound) # normalize max-amplitude to 0 dB
-  songdata = np.array(sound.get_array_of_samples())
-  duration = round(songdata.shape[0]/sound.frame_rate*1000) #ms
-  audiodata = torch.tensor(songdata, device=device).float()
+  with profiler.stage('audio.filter'):
+    if sound.frame_rate > sr:
+        sound = scipy_effects.low_pass_filter(sound, sr/2)
+  with profiler.stage('audio.resample'):
+    if sound.frame_rate != sr:
+        sound = sound.set_frame_rate(sr)
+    if sound.channels > 1:
+        sound = sound.split_to_mono()[0]
+    if not sound.sample_width == 2:
+        sound = sound.set_sample_width(2)
+  with profiler.stage('audio.filter'):
+    if high_pass:
+      sound = sound.high_pass_filter(high_pass)
+  with profiler.stage('audio.normalize'):
+    sound = effects.normalize(sound) # normalize max-amplitude to 0 dB
+    songdata = np.array(sound.get_array_of_samples())
+    duration = round(songdata.shape[0]/sound.frame_rate*1000) #ms
+    audiodata = torch.tensor(songdata, device=device).float()
   print('Standarized audio: channel = %s, sample_rate = %s Hz, sample_size = %s, duration = %s s' %(sound.channels, sound.frame_rate, songdata.shape[0], sound.duration_seconds))
   return sound.frame_rate, audiodata, duration, sound, original_metadata
 
+def pcm_to_samples(raw, sample_width, channels):
+  # first channel of interleaved PCM bytes, scaled to the 16-bit range
+  if sample_width == 3:
+    data = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3)
+    data = (data[:, 0].astype(np.int32) | (data[:, 1].astype(np.int32) << 8) | (data[:, 2].astype(np.int8).astype(np.int32) << 16))
+  elif sample_width == 1:
+    data = np.frombuffer(raw, dtype=np.uint8).astype(np.int32) - 128
+  else:
+    data = np.frombuffer(raw, dtype={2:np.int16, 4:np.int32}[sample_width])
+  return data.reshape(-1, channels)[:, 0].astype(np.float64) * 2.0**(16 - sample_width*8)
+
+def read_audio_blocks(audio_file, block_size=1920000):
+  """
+  Yield (frame_rate, samples) blocks of the first channel without loading the whole file.
+  PCM WAV files are read with the wave module, every other format is decoded through an ffmpeg pipe.
+  """
+  f = None
+  if audio_file[-3:].lower() == 'wav':
+    try:
+      f = wave.open(audio_file, 'rb')
+    except wave.Error:
+      f = None
+  if f:
+    with f:
+      frame_rate, channels, sample_width = f.getframerate(), f.getnchannels(), f.getsampwidth()
+      while True:
+        raw = f.readframes(block_size)
+        if not raw:
+          break
+        yield frame_rate, pcm_to_samples(raw, sample_width, channels)
+    return
+  frame_rate = int(mediainfo(audio_file)['sample_rate'])
+  proc = subprocess.Popen([AudioSegment.converter, '-v', 'error', '-i', audio_file, '-af', 'pan=mono|c0=c0', '-f', 's16le', '-acodec', 'pcm_s16le', '-'], stdout=subprocess.PIPE)
+  try:
+    while True:
+      raw = proc.stdout.read(block_size*2)
+      if not raw:
+        break
+      yield frame_rate, pcm_to_samples(raw[:len(raw)//2*2], 2, 1)
+  finally:
+    proc.stdout.close()
+    proc.wait()
+
+def standarize_blocks(audio_file, sr=320000, high_pass=0, block_size=1920000):
+  # Yield mono blocks resampled to sr and high-passed, before normalization. The filters keep
+  # their state across blocks and resampling interpolates linearly on the global sample grid, on
+  # floats: not pydub's int16 path of AudioStandarize, so the samples and labels differ from it.
+  lp = hp = lp_zi = hp_zi = last = None
+  read = 0      # raw samples consumed so far
+  produced = 0  # standardized samples produced so far
+  blocks = read_audio_blocks(audio_file, block_size)
+  while True:
+    with profiler.stage('audio.decode'):
+      block = next(blocks, None)
+    if block is None:
+      break
+    frame_rate, samples = block
+    if lp is None and hp is None:
+      if frame_rate > sr:
+        lp = butter(5, (sr/2)/(0.5*frame_rate), btype='lowpass', output='sos')
+        lp_zi = np.zeros((lp.shape[0], 2))
+      if high_pass:
+        hp = butter(5, high_pass/(0.5*sr), btype='highpass', output='sos')
+        hp_zi = np.zeros((hp.shape[0], 2))
+    with profiler.stage('audio.filter'):
+      if lp is not None:
+        samples, lp_zi = sosfilt(lp, samples, zi=lp_zi)
+    with profiler.stage('audio.resample'):
+      if frame_rate != sr:
+        xp = np.arange(read - (last is not None), read + samples.shape[0])
+        fp = np.concatenate(([last], samples)) if last is not None else samples
+        stop = (read + samples.shape[0] - 1)*sr//frame_rate + 1
+        out = np.interp(np.arange(produced, stop)*frame_rate/sr, xp, fp)
+        last = samples[-1]
+      else:
+        out = samples
+    read += samples.shape[0]
+    produced += out.shape[0]
+    with profiler.stage('audio.filter'):
+      if hp is not None:
+        out, hp_zi = sosfilt(hp, out, zi=hp_zi)
+    yield frame_rate, out
+
+def AudioStandarizeStream(audio_file, sr=320000, device=None, high_pass=0, window=60000, overlap=128, block_size=1920000):
+  """
+  Streaming counterpart of AudioStandarize. Yields (start, audiodata) windows of window+overlap ms
+  every window ms, so memory is bounded by the window size instead of the file length.
+  A first pass over the standardized blocks finds the peak used for normalization. Filtering and
+  resampling differ from AudioStandarize (see standarize_blocks), so detections of a streamed
+  recording differ from an unstreamed run even when it fits in one window.
+  """
+  if not device:
+    device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+  peak, frame_rate, sample_size = 0, None, 0
+  for frame_rate, samples in standarize_blocks(audio_file, sr, high_pass, block_size):
+    peak = max(peak, np.abs(samples).max())
+    sample_size += samples.shape[0]
+  if not frame_rate:
+    print('Cannot read audio from %s.' %audio_file)
+    return
+  profiler.count('audio_seconds', sample_size/sr)
+  print('Streaming audio: origional sample_rate = %s Hz, standarized sample_size = %s, duration = %s s' %(frame_rate, sample_size, sample_size/sr))
+  gain = (32768 * db_to_float(-0.1) / peak) if peak else 1.0
+  window_size = round(window*sr/1000)
+  overlap_size = round(overlap*sr/1000)
+  buffer = np.zeros(0, dtype=np.float32)
+  buffer_start = 0  # index of buffer[0] in the standardized sample grid
+  for _, samples in standarize_blocks(audio_file, sr, high_pass, block_size):
+    with profiler.stage('audio.normalize'):
+      buffer = np.concatenate((buffer, np.clip(samples*gain, -32768, 32767).astype(np.float32)))
+    while buffer.shape[0] >= window_size + overlap_size:
+      yield round(buffer_start/sr*1000), torch.tensor(buffer[:window_size + overlap_size], device=device)
+      buffer = buffer[window_size:]
+      buffer_start += window_size
+  if buffer.shape[0]:
+    yield round(buffer_start/sr*1000), torch.tensor(buffer, device=device)
+
+def export_model(weights, backend='torchscript', quantize=False, imgsz=640):
+  """
+  Export the detector in weights once for CPU inference and return the path of the export.
+  Exports are cached next to the weights (best.torchscript, best.onnx, best.int8.onnx, with the
+  class names in best.names.json) and rebuilt when the weights are newer. quantize applies
+  dynamic int8 quantization of the weights, which onnxruntime supports for conv layers; it
+  changes the labels (on sample01, 18 of 19 boxes kept and 4 new ones), so check it with
+  'python benchmark.py backend onnx --quantize' before use.
+  """
+  base = os.path.splitext(weights)[0]
+  names_file = base+'.names.json'
+  if backend == 'onnx':
+    if onnxruntime is None:
+      raise ImportError('The onnx backend needs onnxruntime (pip install onnx onnxruntime).')
+    path = base+('.int8.onnx' if quantize else '.onnx')
+  elif backend == 'torchscript':
+    path = base+'.torchscript'
+  else:
+    raise ValueError('Unknown inference backend %s.' %backend)
+  fresh = lambda f: os.path.isfile(f) and os.path.getmtime(f) >= os.path.getmtime(weights)
+  if fresh(path) and fresh(names_file):
+    return path
+  print('Exporting %s to %s...' %(weights, path))
+  model = attempt_load(weights, map_location='cpu')
+  model.float().eval()
+  for m in model.modules():
+    if isinstance(m, Detect):
+      m.onnx_dynamic = True  # rebuild the grids from the input shape instead of caching them
+  img = torch.zeros(1, 3, imgsz, imgsz)
+  names = model.module.names if hasattr(model, 'module') else model.names
+  with open(names_file, 'w', encoding='utf-8') as f:
+    json.dump(names, f)
+  if backend == 'onnx':
+    fp32 = base+'.onnx'
+    if not fresh(fp32):
+      options = {}
+      if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        options['dynamo'] = False  # the TorchScript exporter, which opset_version and dynamic_axes are written for
+      torch.onnx.export(model, img, fp32, opset_version=12, input_names=['images'], output_names=['output'], dynamic_axes={'images':{0:'batch', 2:'height', 3:'width'}, 'output':{0:'batch', 1:'anchors'}}, **options)
+    if quantize:
+      quantize_dynamic(fp32, path, weight_type=QuantType.QUInt8)
+  else:
+    if quantize:
+      # torch's dynamic quantization only covers linear and recurrent layers, the detector has none
+      print('Dynamic int8 quantization needs the onnx backend, exporting float32 TorchScript.')
+    with torch.no_grad():
+      traced = torch.jit.freeze(torch.jit.trace(model, img, strict=False, check_trace=False))
+    torch.jit.save(traced, path)
+  return path
+
+class ExportedModel:
+  """
+  CPU inference through an export of export_model, called like the eager detector. threads sets
+  the intra-op threads of the onnxruntime session, or torch's (process-wide) for TorchScript.
+  """
+  def __init__(self, path, backend='torchscript', threads=None):
+    self.backend = backend
+    if backend == 'onnx':
+      options = onnxruntime.SessionOptions()
+      if threads:
+        options.intra_op_num_threads = threads
+      self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+      self.input_name = self.session.get_inputs()[0].name
+    else:
+      if threads:
+        torch.set_num_threads(threads)
+      self.module = torch.jit.load(path, map_location='cpu')
+
+  def __call__(self, img, augment=False):
+    if self.backend == 'onnx':
+      return (torch.from_numpy(self.session.run(None, {self.input_name:img.cpu().numpy()})[0]),)
+    with torch.no_grad():
+      return (self.module(img.cpu())[0],)
+
+class SilicRegistry:
+  """
+  Process-wide cache of loaded detectors, sound class tables and nnAudio spectrogram layers,
+  so they are built once per process instead of once per SilicBat or browser() call.
+  Models are keyed by weights path, device and inference backend. evict() drops entries;
+  instances that already hold a model keep their own reference.
+  """
+  def __init__(self):
+    self.models = {}
+    self.classes = {}
+    self.layers = {}
+
+  def model(self, weights, device, backend='eager', quantize=False, threads=None):
+    key = (os.path.abspath(weights), str(device), backend, quantize, threads)
+    if key not in self.models:
+      if backend == 'eager':
+        if threads:
+          torch.set_num_threads(threads)
+        model = attempt_load(weights, map_location=device)
+        names = model.module.names if hasattr(model, 'module') else model.names
+        model.float()
+      else:
+        model = ExportedModel(export_model(weights, backend=backend, quantize=quantize), backend=backend, threads=threads)
+        with open(os.path.splitext(weights)[0]+'.names.json', encoding='utf-8') as f:
+          names = json.load(f)
+      self.models[key] = (model, names)
+    return self.models[key]
+
+  def soundclasses(self, weights):
+    key = os.path.abspath(weights)
+    if key not in self.classes:
+      self.classes[key] = pd.read_csv(weights.replace('best.pt', 'soundclasses.csv'), encoding='utf8')
+    return self.classes[key]
+
+  def spectrogram_layers(self, sr, n_fft, hop_length, n_mels, fmin, fmax, device):
+    key = (sr, n_fft, hop_length, n_mels, fmin, fmax, str(device))
+    if key not in self.layers:
+      spec_layer = Spectrogram.STFT(sr=sr, n_fft=n_fft, hop_length=hop_length).to(device)
+      spec_mel_layer = Spectrogram.MelSpectrogram(sr=sr, n_fft=n_fft, n_mels=n_mels, hop_length=hop_length, window='hann', center=True, pad_mode='reflect', power=2.0, htk=False, fmin=fmin, fmax=fmax, norm=1, verbose=True).to(device)
+      self.layers[key] = (spec_layer, spec_mel_layer)
+    return self.layers[key]
+
+  def evict(self, weights=None, device=None):
+    # drop cached entries matching weights and/or device, everything when both are None
+    path = os.path.abspath(weights) if weights else None
+    for key in list(self.models):
+      if (path is None or key[0] == path) and (device is None or key[1] == str(device)):
+        del self.models[key]
+    if device is None:
+      for key in list(self.classes):
+        if path is None or key == path:
+          del self.classes[key]
+    if weights is None:
+      for key in list(self.layers):
+        if device is None or key[-1] == str(device):
+          del self.layers[key]
+    if torch.cuda.is_available():
+      torch.cuda.empty_cache()
+
+default_registry = SilicRegistry()
+
+class TileWriter:
+  """
+  Writes a spectrogram strip that arrives in chunks as fixed-width PNG tiles at zoom levels 1, 1/2,
+  1/4, ... in time, as <path>/<level>/<index>.png, plus a manifest.json with the width and number
+  of tiles per level. Less than one tile per level is buffered, so memory does not grow with the
+  length of the recording.
+  """
+  def __init__(self, path, tile_width=1024, levels=4):
+    self.path = path
+    self.tile_width = tile_width
+    self.levels = max(1, levels)
+    self.buffers = [[] for _ in range(self.levels)]
+    self.widths = [0]*self.levels
+    self.counts = [0]*self.levels
+    self.height = None
+    for level in range(self.levels):
+      os.makedirs(os.path.join(path, str(level)), exist_ok=True)
+
+  def write(self, img, level=0):
+    self.height = img.shape[0]
+    self.buffers[level].append(img)
+    self.widths[level] += img.shape[1]
+    if sum(buffer.shape[1] for buffer in self.buffers[level]) < self.tile_width:
+      return
+    strip = np.hstack(self.buffers[level])
+    n = strip.shape[1]//self.tile_width
+    self.buffers[level] = [strip[:, n*self.tile_width:]] if strip.shape[1] > n*self.tile_width else []
+    for k in range(n):
+      self.save(level, strip[:, k*self.tile_width:(k+1)*self.tile_width])
+
+  def save(self, level, tile):
+    Image.fromarray(np.ascontiguousarray(tile)).save(os.path.join(self.path, str(level), '%s.png' %self.counts[level]), dpi=(72,72))
+    self.counts[level] += 1
+    if level + 1 < self.levels:
+      self.write(cv2.resize(tile, (max(1, int(round(tile.shape[1]/2))), tile.shape[0]), interpolation=cv2.INTER_AREA), level + 1)
+
+  def close(self, duration, **info):
+    # flush the partial last tile of every level, duration (ms) is the time span of the strip
+    for level in range(self.levels):
+      if self.buffers[level]:
+        tile = np.hstack(self.buffers[level])
+        self.buffers[level] = []
+        self.save(level, tile)
+    manifest = dict(info, duration=duration, height=self.height, tile_width=self.tile_width, path='{level}/{index}.png',
+                    levels=[{'width':self.widths[level], 'tiles':self.counts[level]} for level in range(self.levels)])
+    with open(os.path.join(self.path, 'manifest.json'), 'w', encoding='utf-8') as f:
+      json.dump(manifest, f)
+    return manifest
+
 class SilicBat:
   """
     Arguments:
@@ -75,8 +602,15 @@ class SilicBat:
         fmin (int): The starting frequency for the lowest Mel filter bank in Hz
         fmax (int): The ending frequency for the highest Mel filter bank in Hz
         clip_length (int): The duration of each inference in ms
+        spect_engine (str): 'tensor' renders the rainbow spectrogram directly from the mel tensor, 'matplotlib' draws it with pcolormesh (reference mode)
+        registry (SilicRegistry): Cache of models and spectrogram layers, the process-wide registry by default
+        audio_backend (str): 'pydub' decodes every format with pydub (reference), 'native' decodes WAV/FLAC faster with NumPy and scipy, with slightly different filtering and resampling
+        stft_cache_size (int): Bytes of STFT output kept per recording and shared by all spectrograms of it
+        inference_backend (str): 'eager' runs the PyTorch model, 'torchscript' or 'onnx' a CPU export of it cached next to the weights
+        quantize (bool): Dynamic int8 quantization of the exported model (onnx backend)
+        threads (int): CPU threads for inference, the torch default when None
   """
-  def __init__(self, sr=320000, n_fft=800, hop_length=320, n_mels=128, fmin=16000, fmax=150000, device=None, clip_length=128):
+  def __init__(self, sr=320000, n_fft=800, hop_length=320, n_mels=128, fmin=16000, fmax=150000, device=None, clip_length=128, spect_engine='tensor', registry=None, audio_backend='pydub', stft_cache_size=512*1024**2, inference_backend='eager', quantize=False, threads=None):
     self.sr = sr
     self.n_fft = n_fft
     self.hop_length = hop_length
@@ -84,39 +618,176 @@ class SilicBat:
     self.fmin = fmin
     self.fmax = fmax
     self.clip_length = clip_length
+    self.spect_engine = spect_engine
+    self.audio_backend = audio_backend
+    self.stft_cache_size = stft_cache_size
+    self.stft_cache = {}
+    self.inference_backend = inference_backend
+    self.quantize = quantize
+    self.threads = threads
     if device:
       self.device = device
     else:
       self.device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
-    self.spec_layer = Spectrogram.STFT(sr=sr, n_fft=n_fft, hop_length=hop_length).to(self.device)
-    self.spec_mel_layer = Spectrogram.MelSpectrogram(sr=sr, n_fft=n_fft, n_mels=n_mels, hop_length=hop_length, window='hann', center=True, pad_mode='reflect', power=2.0, htk=False, fmin=fmin, fmax=fmax, norm=1, verbose=True).to(self.device)
+    self.registry = registry if registry else default_registry
+    self.spec_layer, self.spec_mel_layer = self.registry.spectrogram_layers(sr, n_fft, hop_length, n_mels, fmin, fmax, self.device)
+    self.mel_min = 1127*np.log(1+fmin/700)
+    self.mel_range = 1127*np.log(1+fmax/700)-self.mel_min
     self.rainbow_img = torch.tensor([], dtype=torch.float32, device=self.device)
     self.model_path = None
     self.model = None
     self.names = None
     self.soundclasses = None
+    self.frame_activity = None
   
   def audio(self, audio_file, ultrasonic=False):
     self.audiofilename = os.path.basename(audio_file)
     self.audiofilename_without_ext = os.path.splitext(self.audiofilename)[0]
     self.audiopath = os.path.dirname(audio_file)
     self.audiofileext = audio_file.split('.')[-1]
-    self.sr, self.audiodata, self.duration, self.sound, self.original_metadata = AudioStandarize(audio_file, self.sr, self.device, high_pass=self.fmin, ultrasonic=ultrasonic)
+    self.frame_activity = None
+    self.free_spectrograms()
+    self.sr, self.audiodata, self.duration, self.sound, self.original_metadata = AudioStandarize(audio_file, self.sr, self.device, high_pass=self.fmin, ultrasonic=ultrasonic, backend=self.audio_backend)
+
+  def audio_stream(self, audio_file, window=60000, overlap=None):
+    # Standardize the recording window by window; self.audiodata and self.duration hold the current window
+    self.audiofilename = os.path.basename(audio_file)
+    self.audiofilename_without_ext = os.path.splitext(self.audiofilename)[0]
+    self.audiopath = os.path.dirname(audio_file)
+    self.audiofileext = audio_file.split('.')[-1]
+    self.sound = None
+    self.original_metadata = None
+    if overlap is None:
+      overlap = self.clip_length
+    for start, audiodata in AudioStandarizeStream(audio_file, self.sr, self.device, high_pass=self.fmin, window=window, overlap=overlap):
+      self.audiodata = audiodata
+      self.duration = round(audiodata.size()[0]/self.sr*1000)
+      self.frame_activity = None
+      self.free_spectrograms()
+      yield start
 
   def save_standarized(self, targetmp3path=None):
     if not targetmp3path:
       targetmp3path = os.path.join(self.audiopath, 'mp3', '%s.mp3'%self.audiofilename_without_ext)
       if not os.path.isdir(os.path.dirname(targetmp3path)):
         os.mkdir(os.path.dirname(targetmp3path))
+    if self.sound is None:
+      self.sound = AudioSegment(np.clip(self.audiodata.cpu().numpy(), -32768, 32767).astype('<i2').tobytes(), frame_rate=self.sr, sample_width=2, channels=1)
     self.sound.export(targetmp3path, bitrate="128k", format="mp3")
     print('Standarized audio was saved to %s' %targetmp3path)
     return targetmp3path
     
-  def spectrogram(self, audiodata, spect_type='linear', rainbow_bands=5):
+  def rainbow_lut(self, rainbow_bands=5, ncolors=32):
+    # one 32-color rainbow slice per band, followed by white for masked (nan/inf) values
+    lut = np.vstack([cm.rainbow(np.linspace((i+1)/rainbow_bands, (i/rainbow_bands), ncolors)) for i in range(rainbow_bands)] + [np.ones((1, 4))])
+    return torch.tensor(np.floor(lut[:, :3]*255+0.5).astype('uint8'), device=self.device)
+
+  def rainbow_tensor(self, spec, rainbow_bands=5, ncolors=32):
+    # Same pixels as the pcolormesh rendering: per-band min/max normalization into 32 colors,
+    # sampled at the pixel centres of a (n_mels/55*100) x (frames/55*100) figure.
+    data = torch.log(torch.log(spec[0] + 1e-6))
+    n_rows = int(self.n_mels/rainbow_bands)
+    n_frames = data.size()[1]
+    h = spec.size()[1]/55*100
+    w = n_frames/55*100
+    idx = torch.full((rainbow_bands*n_rows, n_frames), rainbow_bands*ncolors, dtype=torch.long, device=data.device)
+    for i in range(rainbow_bands):
+      subdata = data[i*n_rows:(i+1)*n_rows]
+      valid = torch.isfinite(subdata)
+      if not valid.any():
+        continue
+      vmin = subdata[valid].min()
+      vmax = subdata[valid].max()
+      norm = (subdata - vmin)/(vmax - vmin) if vmax > vmin else torch.zeros_like(subdata)
+      band = (norm*ncolors).clamp(0, ncolors-1).long() + i*ncolors
+      idx[i*n_rows:(i+1)*n_rows] = torch.where(valid, band, idx[i*n_rows:(i+1)*n_rows])
+    # pixel centre -> data cell, row 0 is the top of the image
+    y = (int(h) - torch.arange(int(h), device=data.device) - 0.5)/h*rainbow_bands
+    band_id = y.floor().clamp(0, rainbow_bands-1)
+    rows = (band_id*n_rows + ((y - band_id)*n_rows).floor().clamp(0, n_rows-1)).long()
+    cols = ((torch.arange(int(w), device=data.device) + 0.5)/w*n_frames).floor().clamp(0, n_frames-1).long()
+    return self.rainbow_lut(rainbow_bands, ncolors)[idx[rows][:, cols]].cpu().numpy()
+
+  def stft(self, first=0, last=None, start=0, stop=None, block_frames=None, max_sample_size=1920000):
+    """
+    Frames first to last of the spec_layer output (complex STFT) of audiodata[start:stop], as if
+    spec_layer had run over the whole slice at once. Every block of block_frames frames reads only
+    its own samples plus the n_fft - hop_length overlap with the next block, reflected at the ends
+    of the slice like the single pass, and is written into one preallocated output. A block holds
+    by default a whole chunk_bounds range of the same max_sample_size, merged tail included, so the
+    chunks of tfr and activity are single conv1d passes and bit for bit equal to spec_layer;
+    splitting a range over several blocks changes the float rounding slightly.
+    spec_mel_layer uses the same n_fft, hop_length and window, so this one pass serves the linear,
+    mel and rainbow spectrograms and the pre-screen. Results are kept per recording, up to
+    stft_cache_size bytes, until free_spectrograms().
+    """
+    x = self.audiodata[start:stop]
+    n = x.size()[0]
+    if not block_frames:
+      block_frames = max_sample_size//self.hop_length + int(self.sr*0.1)//self.hop_length + 1
+    if last is None:
+      last = n//self.hop_length + 1
+    key = (first, last, start, stop)
+    if key in self.stft_cache:
+      return self.stft_cache[key]
+    pad = self.n_fft//2
+    wsin, wcos = self.spec_layer.wsin, self.spec_layer.wcos
+    spec = torch.empty((1, wcos.size()[0], last - first, 2), device=x.device)
+    with torch.no_grad():
+      for f in range(first, last, block_frames):
+        f_end = min(f + block_frames, last)
+        s = f*self.hop_length - pad
+        e = (f_end - 1)*self.hop_length + self.n_fft - pad
+        segment = x[max(s, 0):min(e, n)]
+        if s < 0:
+          segment = torch.cat((x[1:1-s].flip(0), segment))
+        if e > n:
+          segment = torch.cat((segment, x[2*n-1-e:n-1].flip(0)))
+        segment = segment[None, None, :]
+        spec[0, :, f-first:f_end-first, 0] = conv1d(segment, wcos, stride=self.hop_length)[0]
+        spec[0, :, f-first:f_end-first, 1] = -conv1d(segment, wsin, stride=self.hop_length)[0]
+    cached = sum(value.element_size()*value.nelement() for value in self.stft_cache.values())
+    if cached + spec.element_size()*spec.nelement() <= self.stft_cache_size:
+      self.stft_cache[key] = spec
+    return spec
+
+  def mel(self, stft):
+    # spec_mel_layer output computed from a spec_layer output, bit for bit
+    magnitude = torch.sqrt(stft[..., 0].pow(2) + stft[..., 1].pow(2))
+    return torch.matmul(self.spec_mel_layer.mel_basis, magnitude**self.spec_mel_layer.power)
+
+  def free_spectrograms(self):
+    self.stft_cache = {}
+
+  def chunk_bounds(self, start=0, stop=None, max_sample_size=1920000):
+    """
+    Samples (first, last) of the audio between start and stop (ms) and the frame ranges of its STFT
+    that tfr renders separately, max_sample_size/hop_length frames each. The ranges cover every
+    frame; a tail shorter than 0.1 s joins the previous range.
+    """
+    if not stop:
+      stop = self.duration
+    first, last = int(round(start/1000*self.sr)), min(int(round(stop/1000*self.sr)), self.audiodata.size()[0])
+    frames = (last - first)//self.hop_length + 1
+    chunk = max(max_sample_size//self.hop_length, 1)
+    bounds = [[f, min(f + chunk, frames)] for f in range(0, frames, chunk)]
+    if len(bounds) > 1 and (bounds[-1][1] - bounds[-1][0])*self.hop_length < self.sr*0.1:
+      bounds[-2][1] = bounds[-1][1]
+      del bounds[-1]
+    return (first, last), [tuple(bound) for bound in bounds]
+
+  def spectrogram(self, audiodata, spect_type='linear', rainbow_bands=5, engine=None, stft=None):
+    # stft is the spec_layer output of audiodata if already computed, see SilicBat.stft
+    if not engine:
+      engine = self.spect_engine
+    if stft is None:
+      stft = self.spec_layer(audiodata)
     if spect_type in ['mel', 'rainbow']:
-      spec = self.spec_mel_layer(audiodata)
+      spec = self.mel(stft)
       w = spec.size()[2]/55
       h = spec.size()[1]/55
+      if spect_type == 'rainbow' and engine == 'tensor' and rainbow_bands > 1:
+        return self.rainbow_tensor(spec, rainbow_bands=rainbow_bands)
       if spect_type == 'mel':
         fig = plt.figure(figsize=(w, h), dpi=100)
         data = torch.sqrt(torch.sqrt(torch.abs(spec[0]) + 1e-6)).cpu().numpy()
@@ -135,7 +806,7 @@ class SilicBat:
         print('Bins of Rainbow should larger than 0.')
         return False
     else:
-      spec = self.spec_layer(audiodata)
+      spec = stft
       data = torch.sqrt(torch.sqrt(torch.abs(spec[0]) + 1e-6)).cpu().numpy()[:,:,0]
       w = data.shape[1]/100*(5/4)*2
       h = data.shape[0]/100*(1/4)*2
@@ -161,62 +832,137 @@ class SilicBat:
     
     return cv2_img
 
-  def tfr(self, targetfilepath=None, spect_type='linear', rainbow_bands=5, start=0, stop=None):
+  def tfr(self, targetfilepath=None, spect_type='linear', rainbow_bands=5, start=0, stop=None, tiles=False, tile_width=1024, tile_levels=4, save=True, tiler=None):
+    # with tiles, the spectrogram is written as a TileWriter pyramid in the folder targetfilepath
+    # without extension instead of one image; only the rainbow strip is still kept for detect.
+    # A tiler that is already open gets the chunks appended and is left open for the caller;
+    # without save, nothing is written and only the strip is kept
     if self.clip_length and ((self.audiodata.size()[0] / self.sr * 1000) < self.clip_length):
         self.audiodata = torch.cat((self.audiodata, torch.zeros(round(self.clip_length*self.sr/1000)-self.audiodata.size()[0], device=self.device)), 0)
+        self.free_spectrograms()
     if not stop:
         stop = self.duration
     max_sample_size = 1920000
-    if not targetfilepath:
-      targetfilepath = os.path.join(self.audiopath, spect_type, '%s.jpg'%self.audiofilename_without_ext)
+    if save and not tiler:
+      if not targetfilepath:
+        targetfilepath = os.path.join(self.audiopath, spect_type, '%s.jpg'%self.audiofilename_without_ext)
+        if not os.path.isdir(os.path.dirname(targetfilepath)):
+          os.mkdir(os.path.dirname(targetfilepath))
       if not os.path.isdir(os.path.dirname(targetfilepath)):
-        os.mkdir(os.path.dirname(targetfilepath))
-    if not os.path.isdir(os.path.dirname(targetfilepath)):
-      print('Error! Cannot find the target folder %s.' %os.path.dirname(targetfilepath))
-      exit()
-    if (stop - start)/1000*self.sr > (max_sample_size):
+        print('Error! Cannot find the target folder %s.' %os.path.dirname(targetfilepath))
+        exit()
+    appending = tiler is not None
+    if tiles and save and not tiler:
+      tiler = TileWriter(os.path.splitext(targetfilepath)[0], tile_width=tile_width, levels=tile_levels)
+    keep = not tiler or spect_type == 'rainbow'
+    (first, last), bounds = self.chunk_bounds(start, stop, max_sample_size)
+    if len(bounds) > 1:
         if not os.path.exists('tmp'):
             try:
                 os.mkdir('tmp')
             except:
                 print('Cannot create tmp folder!')
                 exit()
-        
-        imgs = []
-        for ts in range(int(round(start/1000*self.sr)), int(round(stop/1000*self.sr)-self.sr*0.1), max_sample_size):
-            if ts+max_sample_size > round(stop/1000*self.sr):
-              data = self.audiodata[ts:round(stop/1000*self.sr)+1]
-            else:
-              data = self.audiodata[ts:ts+max_sample_size]
-            try:
-              imgs.append(self.spectrogram(data, spect_type, rainbow_bands=rainbow_bands))
-            except:
-              print('error in converting')
-              exit()
-        self.cv2_img = cv2.hconcat(imgs)
-    else:
-        self.cv2_img = self.spectrogram(self.audiodata[int(round(start/1000*self.sr)):int(round(stop/1000*self.sr))], spect_type, rainbow_bands=rainbow_bands)
+    imgs = []
+    for f, f_end in bounds:
+        try:
+          with profiler.stage('spectrogram'):
+            img = self.spectrogram(None, spect_type, rainbow_bands=rainbow_bands, stft=self.stft(f, f_end, first, last))
+        except:
+          print('error in converting')
+          exit()
+        if tiler:
+          with profiler.stage('spectrogram.save'):
+            tiler.write(img)
+        if keep:
+          imgs.append(img)
+    if keep:
+      self.cv2_img = cv2.hconcat(imgs) if len(imgs) > 1 else imgs[0]
     
     if spect_type == 'rainbow' and rainbow_bands == 5:
       self.rainbow_img = cv2.cvtColor(self.cv2_img, cv2.COLOR_RGB2BGR)
     
+    if appending:
+      return tiler.path
+    if tiler:
+      with profiler.stage('spectrogram.save'):
+        tiler.close(stop - start, spect_type=spect_type)
+      print('Spectrogram tiles were saved to %s.'%tiler.path)
+      return tiler.path
+    if not save:
+      return None
     height, width, colors = self.cv2_img.shape
     #cv2.imwrite(targetfilepath, self.cv2_img)
-    PILimage = Image.fromarray(self.cv2_img)
-    try:
-      PILimage.save(targetfilepath, dpi=(72,72))
-    except:
-      targetfilepath = '%spng' %targetfilepath[:-3]
-      PILimage.save(targetfilepath, dpi=(72,72))
+    with profiler.stage('spectrogram.save'):
+      PILimage = Image.fromarray(self.cv2_img)
+      try:
+        PILimage.save(targetfilepath, dpi=(72,72))
+      except:
+        targetfilepath = '%spng' %targetfilepath[:-3]
+        PILimage.save(targetfilepath, dpi=(72,72))
     print('Spectrogram was saved to %s.'%targetfilepath)
     return targetfilepath
 
   def mel_to_freq(self, mel):
     if mel < 0:
       return self.fmin
-    mel = mel*(1127*np.log(1+self.fmax/700)-1127*np.log(1+self.fmin/700)) + 1127*np.log(1+self.fmin/700)
+    mel = mel*self.mel_range + self.mel_min
     return round((700*(np.exp(mel/1127)-1)).astype('float32'))
 
+  def mel_to_freqs(self, mel):
+    # mel_to_freq of an array
+    freq = np.round((700*(np.exp((mel*self.mel_range + self.mel_min)/1127)-1)).astype('float32')).astype(int)
+    return np.where(mel < 0, self.fmin, freq)
+
+  def freq_to_y(self, freq):
+    # inverse of mel_to_freq as the distance from the top of the spectrogram, 0 (fmax) to 1 (fmin)
+    mel = 1127*np.log(1+np.asarray(freq, dtype=float)/700)
+    return np.clip(1-(mel-self.mel_min)/self.mel_range, 0, 1)
+
+  def band_rows(self, classes, margin=0.1):
+    # rows of rainbow_img covering the frequency ranges of the class indices, widened by margin
+    height = self.rainbow_img.shape[0]
+    top, bottom = self.freq_to_y([self.class_bands[classes, 1].max()*(1+margin), self.class_bands[classes, 0].min()*(1-margin)])*height
+    return max(int(np.floor(top)), 0), min(int(np.ceil(bottom)), height)
+
+  def band_filter(self, pred, img_shape, shape0, rows, margin=0.1, classes=None):
+    """
+    Zero the objectness of raw predictions whose frequency band does not overlap the range of
+    their best class (widened by margin), or whose best class is not in classes, so that
+    non_max_suppression drops them with the other low confidence boxes. pred holds xywh in
+    letterboxed pixels of img_shape made from clips of shape0 cut from rows of rainbow_img.
+    """
+    gain = min(img_shape[0]/shape0[0], img_shape[1]/shape0[1])
+    pad = (img_shape[0]-shape0[0]*gain)/2
+    bands = self.freq_to_y(self.class_bands[:, ::-1]*[1+margin, 1-margin])*self.rainbow_img.shape[0]
+    bands = torch.as_tensor((bands-rows[0])*gain+pad, dtype=pred.dtype, device=pred.device)  # top and bottom of every class range
+    cls = pred[..., 5:].argmax(-1)
+    top = pred[..., 1]-pred[..., 3]/2
+    bottom = pred[..., 1]+pred[..., 3]/2
+    keep = (top <= bands[cls, 1]) & (bottom >= bands[cls, 0])
+    if classes:
+      keep &= torch.isin(cls, torch.tensor(classes, device=cls.device))
+    with torch.no_grad():
+      pred[..., 4] *= keep
+    return pred
+
+  def det_to_labels(self, det, gn, path, time_start):
+    """
+    Label rows of the detections of one clip at once: det holds xyxy in clip pixels, conf and
+    class index per row, gn the whwh normalization gain. Same values and order as converting
+    every box with xywh2ttff, with the columns computed as arrays.
+    """
+    xywh = (xyxy2xywh(det[:, :4]) / gn).flip(0).cpu().numpy().astype(float)    # normalized xywh, reversed like the per-box loop
+    x, y, w, h = xywh.T
+    cls = det[:, 5].flip(0).long().cpu().numpy()
+    columns = [[path]*len(cls)] + [column[cls].tolist() for column in self.class_columns]
+    columns.append((time_start + np.round((x-w/2)*self.clip_length).astype(int)).tolist())
+    columns.append((time_start + np.round((x+w/2)*self.clip_length).astype(int)).tolist())
+    columns.append(self.mel_to_freqs(1-(y+h/2)).tolist())
+    columns.append(self.mel_to_freqs(1-(y-h/2)).tolist())
+    columns.append([round(conf, 3) for conf in det[:, 4].flip(0).cpu().tolist()])
+    return [list(row) for row in zip(*columns)]
+
   def xywh2ttff(self, xywh):
     x, y, w, h = list(xywh)
     ts = round((x-w/2)*self.clip_length)
@@ -225,69 +971,256 @@ class SilicBat:
     fh = self.mel_to_freq(1-(y-h/2))
     return [ts, te, fl, fh]
 
-  def detect(self, weights, step=100, conf_thres=0.1, imgsz=640, targetfilepath=None, iou_thres=0.25, targetclasses=None):
+  def activity(self, max_sample_size=1920000):
+    """
+    Activity of every spectrogram frame in dB: the largest excess of a mel band (fmin to fmax) over
+    its own noise floor, the median of that band in the same tfr chunk, so the floor follows slow
+    changes of the background noise. Computed once per recording from the shared STFT.
+    """
+    if self.frame_activity is not None:
+      return self.frame_activity
+    (first, last), bounds = self.chunk_bounds(max_sample_size=max_sample_size)
+    scores = []
+    with torch.no_grad():
+      for f, f_end in bounds:
+        db = 10*torch.log10(self.mel(self.stft(f, f_end, first, last))[0] + 1e-10)
+        scores.append((db - db.median(dim=1, keepdim=True).values).max(dim=0).values.cpu().numpy())
+    self.frame_activity = np.concatenate(scores)
+    return self.frame_activity
+
+  def active_clips(self, step=100, scan_stop=None, threshold=15, padding=1):
+    # start times (ms) of the clips whose loudest frame is threshold dB above the noise floor, with padding neighbours on each side
+    starts = np.arange(0, min(self.duration, scan_stop) if scan_stop else self.duration, step)
+    if not starts.size:
+      return set()
+    activity = self.activity()
+    frames_per_ms = self.sr/self.hop_length/1000
+    clip_frames = max(int(round(self.clip_length*frames_per_ms)), 1)
+    padded = np.concatenate((activity, np.full(clip_frames, -np.inf, dtype=activity.dtype)))
+    first = np.minimum(np.round(starts*frames_per_ms).astype(int), activity.shape[0])
+    active = np.lib.stride_tricks.sliding_window_view(padded, clip_frames)[first].max(axis=1) >= threshold
+    if padding:
+      active = np.convolve(active, np.ones(2*padding+1), mode='same') > 0
+    profiler.count('windows', starts.size)
+    profiler.count('windows_skipped', int((~active).sum()))
+    print('Pre-screen: %s of %s clips are active.' %(int(active.sum()), starts.size))
+    return set(starts[active].tolist())
+
+  def load_model(self, weights):
     if self.model and self.model_path == weights:
-      pass
-    else:
-      self.model_path = weights
-      model = attempt_load(self.model_path, map_location=self.device)
-      self.names = model.module.names if hasattr(model, 'module') else model.names
-      model.float()
-      self.model = model
-      self.soundclasses = pd.read_csv(self.model_path.replace('best.pt', 'soundclasses.csv'), encoding='utf8', index_col='sounclass_id').T.to_dict()
-    if targetclasses:
-      classes = [self.names.index(name) for name in targetclasses]
-    else:
-      classes = None
-    self.tfr(targetfilepath=targetfilepath, spect_type='rainbow')
-    
-    # prepare input data clips
+      return
+    self.model_path = weights
+    self.model, self.names = self.registry.model(weights, self.device, backend=self.inference_backend, quantize=self.quantize, threads=self.threads)
+    soundclasses = self.registry.soundclasses(weights).set_index('sounclass_id')
+    self.soundclasses = soundclasses.T.to_dict()
+    # (freq_low, freq_high) of every model class, unlimited for classes without a known range
+    bands = soundclasses.reindex(self.names).reindex(columns=['freq_low', 'freq_high'])
+    self.class_bands = np.stack([bands['freq_low'].fillna(0).to_numpy(float), bands['freq_high'].fillna(np.inf).to_numpy(float)], axis=1)
+    # label columns of every model class, looked up by class index in det_to_labels
+    self.class_columns = [np.array(self.names, dtype=object)]
+    for column in ['species_name', 'sound_class', 'scientific_name']:
+      self.class_columns.append(np.array([self.soundclasses.get(name, {}).get(column) for name in self.names], dtype=object))
+
+  def detect(self, weights, step=100, conf_thres=0.1, imgsz=640, targetfilepath=None, iou_thres=0.25, targetclasses=None, batch_size=None, scan_stop=None, tiling=False, prescreen=None, prescreen_padding=1, tiles=False, class_bands=False, band_margin=0.1, band_crop=False, save=True):
+    # without save, the rainbow spectrogram is only rendered for the model, not written
+    self.load_model(weights)
+    self.tfr(targetfilepath=targetfilepath, spect_type='rainbow', tiles=tiles, save=save)
+    return self.detect_clips(step=step, conf_thres=conf_thres, imgsz=imgsz, iou_thres=iou_thres, targetclasses=targetclasses, batch_size=batch_size, scan_stop=scan_stop, tiling=tiling, prescreen=prescreen, prescreen_padding=prescreen_padding, class_bands=class_bands, band_margin=band_margin, band_crop=band_crop)
+
+  def prepare_clips(self, step=100, imgsz=640, scan_stop=None, stride=32, active=None, rows=None):
+    # letterbox every clip of rainbow_img separately, only the clips starting at active and the
+    # rows[0]:rows[1] of them if given, at the scale of the whole clip
+    rainbow_img = self.rainbow_img if rows is None else self.rainbow_img[rows[0]:rows[1]]
+    new_shape = imgsz
+    if rows is not None:
+      # the stride multiple around the cropped rows at the scale of the whole clip
+      clip_width = round(self.clip_length/self.duration*rainbow_img.shape[1])
+      r = min(imgsz/self.rainbow_img.shape[0], imgsz/clip_width)
+      new_shape = (int(np.ceil(rainbow_img.shape[0]*r/stride))*stride, imgsz)
     dataset = []
-    for ts in range(0, self.duration, step):
-      clip_start = round(ts/self.duration*self.rainbow_img.shape[1])
-      clip_end = clip_start+round(self.clip_length/self.duration*self.rainbow_img.shape[1])
-      if clip_end > self.rainbow_img.shape[1]:
-        _silence = np.full((self.rainbow_img.shape[0],clip_end-self.rainbow_img.shape[1],3),255).astype('float32')
-        _rainbow_img = np.append(self.rainbow_img,_silence,axis=1)
+    for ts in range(0, min(self.duration, scan_stop) if scan_stop else self.duration, step):
+      clip_start = round(ts/self.duration*rainbow_img.shape[1])
+      clip_end = clip_start+round(self.clip_length/self.duration*rainbow_img.shape[1])
+      if active is not None and ts not in active:
+        if clip_end > rainbow_img.shape[1]:
+          break
+        continue
+      if clip_end > rainbow_img.shape[1]:
+        _silence = np.full((rainbow_img.shape[0],clip_end-rainbow_img.shape[1],3),255).astype('float32')
+        _rainbow_img = np.append(rainbow_img,_silence,axis=1)
         img0 = _rainbow_img[:,clip_start:clip_end]
-        img = letterbox(img0, new_shape=imgsz)[0]
+        img = letterbox(img0, new_shape=new_shape)[0]
         # Convert
         img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x416x416
         img = np.ascontiguousarray(img)
-        dataset.append([os.path.join(self.audiopath, self.audiofilename), img, img0, ts])
+        dataset.append([os.path.join(self.audiopath, self.audiofilename), img, img0.shape, ts])
         break
-      img0 = self.rainbow_img[:,clip_start:clip_end]
-      img = letterbox(img0, new_shape=imgsz)[0]
+      img0 = rainbow_img[:,clip_start:clip_end]
+      img = letterbox(img0, new_shape=new_shape)[0]
       # Convert
       img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x416x416
       img = np.ascontiguousarray(img)
-      dataset.append([os.path.join(self.audiopath, self.audiofilename), img, img0, ts])
+      dataset.append([os.path.join(self.audiopath, self.audiofilename), img, img0.shape, ts])
+    return dataset, None
+
+  def tile_clips(self, step=100, imgsz=640, scan_stop=None, stride=32, active=None, rows=None):
+    """
+    Tiling counterpart of prepare_clips. rainbow_img is padded once at the end, resized to model
+    scale once and flipped to RGB CHW as a view, so every clip is a zero-copy window of it.
+    Returns the clips and the letterbox border (top, bottom, left, right) to add when batching.
+    """
+    path = os.path.join(self.audiopath, self.audiofilename)
+    height, width = self.rainbow_img.shape[:2]
+    clip_width = round(self.clip_length/self.duration*width)
+    starts = []
+    for ts in range(0, min(self.duration, scan_stop) if scan_stop else self.duration, step):
+      starts.append((ts, round(ts/self.duration*width)))
+      if starts[-1][1] + clip_width > width:
+        break
+    if active is not None:
+      starts = [start for start in starts if start[0] in active]
+    if not starts:
+      return [], None
+    img = self.rainbow_img
+    # same geometry as letterbox on a single clip, only rows[0]:rows[1] of it if given
+    r = min(imgsz/height, imgsz/clip_width)
+    if rows is not None:
+      img = img[rows[0]:rows[1]]
+      height = img.shape[0]
+    if starts[-1][1] + clip_width > width:
+      img = cv2.copyMakeBorder(img, 0, 0, 0, starts[-1][1] + clip_width - width, cv2.BORDER_CONSTANT, value=(255, 255, 255))
+    new_w, new_h = int(round(clip_width*r)), int(round(height*r))
+    dw, dh = np.mod(imgsz - new_w, stride)/2, np.mod(imgsz - new_h, stride)/2
+    border = (int(round(dh - 0.1)), int(round(dh + 0.1)), int(round(dw - 0.1)), int(round(dw + 0.1)))
+    if (new_w, new_h) != (clip_width, height):
+      img = cv2.resize(img, (int(round(img.shape[1]*r)), new_h), interpolation=cv2.INTER_LINEAR)
+    img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, CHW view
+    dataset = []
+    for ts, clip_start in starts:
+      x0 = min(int(round(clip_start*r)), img.shape[2] - new_w)
+      dataset.append([path, img[:, :, x0:x0+new_w], (height, clip_width, 3), ts])
+    return dataset, border
+
+  def detect_clips(self, step=100, conf_thres=0.1, imgsz=640, iou_thres=0.25, targetclasses=None, batch_size=None, scan_stop=None, tiling=False, prescreen=None, prescreen_padding=1, class_bands=False, band_margin=0.1, band_crop=False):
+    # run the loaded model over the current rainbow_img; with prescreen (dB above the noise floor,
+    # True for 15 dB, None or False for off), only over the active clips and prescreen_padding
+    # clips around them; with class_bands, boxes outside the frequency range of their class
+    # (soundclasses.csv) are dropped before NMS. With band_crop, the clips are also cropped to
+    # the frequency ranges of targetclasses: faster, but the model sees less context and scores
+    # drop (on sample01 with 498, by up to 0.24, e.g. 0.575 -> 0.333) and box edges move, so
+    # calls can fall below conf_thres
+    if targetclasses:
+      classes = [self.names.index(name) for name in targetclasses]
+    else:
+      classes = None
+    active = None
+    if prescreen is not None and prescreen is not False:
+      with profiler.stage('prescreen'):
+        active = self.active_clips(step=step, scan_stop=scan_stop, threshold=15 if prescreen is True else prescreen, padding=prescreen_padding)
     
+    rows = None
+    if band_crop and classes:
+      rows = self.band_rows(classes, margin=band_margin)
+      if rows == (0, self.rainbow_img.shape[0]):
+        rows = None
     
-    labels = [['file', 'classid', 'species_name', 'sound_class', 'scientific_name', "time_begin", "time_end", "freq_low", "freq_high", "score"]]
-    for path, img, im0, time_start in dataset:
-      img = torch.from_numpy(img).float().to(self.device)
-      img /= 255.0  # 0 - 255 to 0.0 - 1.0
-      if img.ndimension() == 3:
-        img = img.unsqueeze(0)
+    # prepare input data clips
+    with profiler.stage('clips'):
+      if tiling:
+        dataset, border = self.tile_clips(step=step, imgsz=imgsz, scan_stop=scan_stop, active=active, rows=rows)
+      else:
+        dataset, border = self.prepare_clips(step=step, imgsz=imgsz, scan_stop=scan_stop, active=active, rows=rows)
+    profiler.count('clips', len(dataset))
+    
+    labels = [list(LABEL_COLUMNS)]
+    if batch_size is None:
+      # batching pays off on a GPU; on CPU the larger tensors were slower than single clips
+      batch_size = 1 if str(self.device) == 'cpu' else 16
+    batch_size = max(1, int(batch_size))
+    for b in range(0, len(dataset), batch_size):
+      batch = dataset[b:b+batch_size]
+      with profiler.stage('clips'):
+        if border:
+          # the only copy of a tiled clip: into the letterboxed batch
+          top, bottom, left, right = border
+          h, w = batch[0][1].shape[1:]
+          img = np.full((len(batch), 3, h+top+bottom, w+left+right), 114, dtype=np.uint8)
+          for k, clip in enumerate(batch):
+            img[k, :, top:top+h, left:left+w] = clip[1]
+        else:
+          # all clips share the same width, so the letterboxed images can be stacked
+          img = np.stack([clip[1] for clip in batch])
+        img = torch.from_numpy(img).float().to(self.device)
+        img /= 255.0  # 0 - 255 to 0.0 - 1.0
       # Inference
-      pred = self.model(img, augment=False)[0]
-      pred = non_max_suppression(pred, conf_thres=conf_thres, iou_thres=iou_thres, classes=classes)
-      for det in pred:    # detections per image
-        gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]    # normalization gain whwh
-        if len(det):
-          det[:, :4] = scale_coords(img.shape[2:], det[:, :4], im0.shape).round()
-          for *xyxy, conf, cls in reversed(det):
-            xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()    # normalized xywh
-            ttff = self.xywh2ttff(xywh)
-            ts, te, fl, fh = ttff
-            classid = self.names[int(cls)]
-            species_name = self.soundclasses[classid]['species_name']
-            sound_class = self.soundclasses[classid]['sound_class']
-            scientific_name = self.soundclasses[classid]['scientific_name']
-            labels.append([path, classid, species_name, sound_class, scientific_name, round(time_start+ts), round(time_start+te), fl, fh, round(float(conf),3)])
+      with profiler.stage('forward'):
+        pred = self.model(img, augment=False)[0]
+      if class_bands:
+        with profiler.stage('bands'):
+          pred = self.band_filter(pred, img.shape[2:], batch[0][2], rows or (0, self.rainbow_img.shape[0]), margin=band_margin, classes=classes)
+      with profiler.stage('nms'):
+        pred = non_max_suppression(pred, conf_thres=conf_thres, iou_thres=iou_thres, classes=classes)
+      with profiler.stage('postprocess'):
+        for (path, _, shape0, time_start), det in zip(batch, pred):    # detections per image
+          gn = torch.tensor([shape0[1], self.rainbow_img.shape[0]], device=det.device)[[0, 1, 0, 1]]    # normalization gain whwh
+          if len(det):
+            det[:, :4] = scale_coords(img.shape[2:], det[:, :4], shape0).round()
+            if rows:
+              det[:, [1, 3]] += rows[0]
+            labels.extend(self.det_to_labels(det, gn, path, time_start))
+    profiler.count('detections', len(labels)-1)
     
     return labels
+
+  def detect_stream(self, audio_file, weights, window=60000, step=100, targetpath=None, linearpath=None, tile_width=1024, tile_levels=4, **kwargs):
+    """
+    Run detect over a long recording in overlapping windows. Each window owns the clips that start
+    inside it and carries clip_length ms of overlap, so boxes crossing a window edge are detected
+    whole and are merged like any other overlapping boxes by clean_multi_boxes. The part of the
+    rainbow (and, with linearpath, linear) spectrogram that each window owns is appended to one
+    TileWriter pyramid per recording, <targetpath>/<name> and <linearpath>/<name>. Both are
+    computed over the whole window, overlap included, so there are no seams at window edges.
+    The audio is standardized by AudioStandarizeStream, so scores and boxes differ from detect
+    on the same recording.
+    """
+    window = max(step, window//step*step)
+    labels = None
+    tilers = {}
+    end = 0
+    for start in self.audio_stream(audio_file, window=window):
+      if not tilers:
+        if not targetpath:
+          targetpath = os.path.join(self.audiopath, 'rainbow')
+          if not os.path.isdir(targetpath):
+            os.mkdir(targetpath)
+        tilers['rainbow'] = TileWriter(os.path.join(targetpath, self.audiofilename_without_ext), tile_width=tile_width, levels=tile_levels)
+        if linearpath:
+          tilers['linear'] = TileWriter(os.path.join(linearpath, self.audiofilename_without_ext), tile_width=tile_width, levels=tile_levels)
+      own = min(window, self.duration)  # the overlap is owned by the next window
+      end = start + own
+      def append(spect_type):
+        # cut at the global column of end (the last column is the frame at the end of the window),
+        # so rounding does not add up over the windows
+        tiler = tilers[spect_type]
+        columns = round(end*(self.cv2_img.shape[1] - 1)/self.duration) - tiler.widths[0]
+        with profiler.stage('spectrogram.save'):
+          tiler.write(self.cv2_img[:, :max(0, min(columns, self.cv2_img.shape[1]))])
+      if linearpath:
+        self.tfr(spect_type='linear', save=False)
+        append('linear')
+      window_labels = self.detect(weights, step=step, scan_stop=window, save=False, **kwargs)
+      append('rainbow')
+      if labels is None:
+        labels = window_labels[:1]
+      for label in window_labels[1:]:
+        label[5] += start
+        label[6] += start
+        labels.append(label)
+    with profiler.stage('spectrogram.save'):
+      for spect_type, tiler in tilers.items():
+        tiler.close(end, spect_type=spect_type)
+        print('Spectrogram tiles were saved to %s.'%tiler.path)
+    return labels if labels is not None else [list(LABEL_COLUMNS)]
     
 def get_iou(bb1, bb2):
   """
@@ -352,7 +1285,77 @@ def merge_boxes(bb1, bb2):
     y2 = bb2['y2']
   return {'x1':x1, 'x2':x2, 'y1':y1, 'y2':y2}
 
-def clean_multi_boxes(labels, threshold_iou=0.25, threshold_iratio=0.5):
+def sweep_multi_boxes(labels, threshold_iou=0.25, threshold_iratio=0.5):
+  """
+  NumPy engine of clean_multi_boxes with identical output. Boxes of each class are swept in
+  time_begin order and IoU / intersection ratios are computed at once against the candidate
+  window, i.e. the later boxes that start before the current box ends plus the boxes whose
+  time_begin was pulled earlier by a previous merge.
+  """
+  df = pd.DataFrame(labels[1:],columns=labels[0])
+  df = df.sort_values('time_begin')
+  results = []
+  for classid in df['classid'].unique():
+    df_class = df[df['classid']==classid].reset_index(drop=True)
+    x1 = df_class['time_begin'].to_numpy(copy=True)
+    x2 = df_class['time_end'].to_numpy(copy=True)
+    y1 = df_class['freq_low'].to_numpy(copy=True)
+    y2 = df_class['freq_high'].to_numpy(copy=True)
+    score = df_class['score'].to_numpy(copy=True)
+    begins = x1.copy()  # sorted, as x1 before any merge
+    n = x1.shape[0]
+    keep = np.zeros(n, dtype=bool)
+    lowered = []  # rows after the current one whose time_begin was moved earlier by a merge
+    for i in range(n):
+      if lowered:
+        lowered = [j for j in lowered if j > i]
+      if threshold_iou <= 0 or threshold_iratio < 0:
+        # every pair merges, touching or not
+        candidates = np.arange(i+1, n)
+      else:
+        hi = np.searchsorted(begins, x2[i], side='right')
+        candidates = np.arange(i+1, max(i+1, hi))
+        if lowered:
+          candidates = np.concatenate((candidates, sorted(j for j in lowered if j >= hi))).astype(int)
+      j = None
+      if candidates.shape[0]:
+        x_left = np.maximum(x1[i], x1[candidates])
+        x_right = np.minimum(x2[i], x2[candidates])
+        y_top = np.maximum(y1[i], y1[candidates])
+        y_bottom = np.minimum(y2[i], y2[candidates])
+        overlap = (x_right >= x_left) & (y_bottom >= y_top)
+        intersection_area = (x_right - x_left) * (y_bottom - y_top)
+        bb1_area = (x2[i] - x1[i]) * (y2[i] - y1[i])
+        bb2_area = (x2[candidates] - x1[candidates]) * (y2[candidates] - y1[candidates])
+        with np.errstate(divide='ignore', invalid='ignore'):
+          iou = np.where(overlap, intersection_area / (bb1_area + bb2_area - intersection_area).astype(float), 0.0)
+          i_ration = np.where(overlap, np.maximum(intersection_area / bb1_area, intersection_area / bb2_area), 0.0)
+        hits = np.nonzero((iou >= threshold_iou) | (i_ration > threshold_iratio))[0]
+        if hits.shape[0]:
+          j = candidates[hits[0]]
+      if j is None:
+        keep[i] = True
+        continue
+      if x1[i] < x1[j]:
+        x1[j] = x1[i]
+        lowered.append(j)
+      x2[j] = max(x2[i], x2[j])
+      y1[j] = min(y1[i], y1[j])
+      y2[j] = max(y2[i], y2[j])
+      score[j] = max(score[i], score[j])
+    df_class['time_begin'] = x1
+    df_class['time_end'] = x2
+    df_class['freq_low'] = y1
+    df_class['freq_high'] = y2
+    df_class['score'] = score
+    results.append(df_class[keep])
+  if not results:
+    return pd.DataFrame(columns=labels[0])
+  return pd.concat(results, ignore_index=True).sort_values('time_begin').reset_index(drop=True)
+
+def clean_multi_boxes(labels, threshold_iou=0.25, threshold_iratio=0.5, engine='numpy'):
+  if engine == 'numpy':
+    return sweep_multi_boxes(labels, threshold_iou=threshold_iou, threshold_iratio=threshold_iratio)
   df = pd.DataFrame(labels[1:],columns=labels[0])
   df = df.sort_values('time_begin')
   df_results = pd.DataFrame()
@@ -422,8 +1425,368 @@ def draw_labels(silic, labels, outputpath=None):
   return targetpath
 
 
-def browser(audiosource, weights='model/exp/best.pt', step=100, targetclasses=[], conf_thres=0.1, savepath=None, zip=True):
+class LabelStore:
+  """
+  Array-backed table of cleaned labels for a whole survey. File names and species columns are
+  interned: every row holds an int32 code into files and its classid, whose names are kept once
+  in classes. Times and frequencies are int32 and scores float32, so concatenating the results of
+  many recordings is a single copy of a few arrays instead of a chain of DataFrame appends.
+  """
+  INT_COLUMNS = ['time_begin', 'time_end', 'freq_low', 'freq_high']
+  NAME_COLUMNS = ['species_name', 'sound_class', 'scientific_name']
+
+  def __init__(self, files=None, columns=None, classes=None):
+    self.files = list(files) if files is not None else []
+    self.columns = columns if columns else {name:np.zeros(0, dtype=np.int32) for name in ['file', 'classid'] + self.INT_COLUMNS}
+    if 'score' not in self.columns:
+      self.columns['score'] = np.zeros(0, dtype=np.float32)
+    self.classes = classes if classes is not None else pd.DataFrame(columns=self.NAME_COLUMNS)
+
+  def __len__(self):
+    return self.columns['score'].shape[0]
+
+  @classmethod
+  def from_frame(cls, df):
+    # df has the LABEL_COLUMNS of clean_multi_boxes
+    codes, files = pd.factorize(df['file'].astype(str))
+    columns = {'file':codes.astype(np.int32), 'classid':df['classid'].to_numpy(dtype=np.int32)}
+    for name in cls.INT_COLUMNS:
+      columns[name] = df[name].to_numpy(dtype=np.int32)
+    columns['score'] = df['score'].to_numpy(dtype=np.float32)
+    classes = df.drop_duplicates('classid').set_index('classid')[cls.NAME_COLUMNS]
+    classes.index = classes.index.astype(np.int32)
+    return cls(files, columns, classes)
+
+  @classmethod
+  def from_labels(cls, labels):
+    # labels is the list of lists returned by detect, header first
+    return cls.from_frame(pd.DataFrame(labels[1:], columns=labels[0]))
+
+  @classmethod
+  def concat(cls, stores):
+    stores = [store for store in stores if store is not None and len(store)]
+    if not stores:
+      return cls()
+    files = {}
+    codes = []
+    for store in stores:
+      remap = np.array([files.setdefault(name, len(files)) for name in store.files], dtype=np.int32)
+      codes.append(remap[store.columns['file']])
+    columns = {'file':np.concatenate(codes)}
+    for name in ['classid'] + cls.INT_COLUMNS + ['score']:
+      columns[name] = np.concatenate([store.columns[name] for store in stores])
+    classes = pd.concat([store.classes for store in stores])
+    return cls(list(files), columns, classes[~classes.index.duplicated()])
+
+  def classids(self):
+    return np.unique(self.columns['classid'])
+
+  def to_frame(self, categorical=False):
+    # the LABEL_COLUMNS table, with file and species names as categoricals if categorical
+    classid = self.columns['classid']
+    df = pd.DataFrame({'file':pd.Categorical.from_codes(self.columns['file'], self.files) if len(self.files) else pd.Categorical([]), 'classid':classid})
+    names = self.classes.reindex(classid)
+    for name in self.NAME_COLUMNS:
+      df[name] = pd.Categorical(names[name].to_numpy()) if categorical else names[name].to_numpy()
+    for name in self.INT_COLUMNS:
+      df[name] = self.columns[name]
+    df['score'] = np.round(self.columns['score'].astype(np.float64), 3)
+    if not categorical:
+      df['file'] = df['file'].astype(object)
+    return df[LABEL_COLUMNS]
+
+  def to_csv(self, path):
+    self.to_frame().to_csv(path, index=False)
+
+  def to_parquet(self, path):
+    # needs pyarrow or fastparquet, like DataFrame.to_parquet
+    self.to_frame(categorical=True).to_parquet(path, index=False)
+
+  def labels_js_rows(self, chunk_size=100000):
+    # yield "['file', time_begin, time_end, freq_low, freq_high, classid, score],\n" rows, chunk_size
+    # rows per string, formatted with one %-operation per chunk instead of one per row
+    files = np.array(self.files, dtype=object)
+    score = np.round(self.columns['score'].astype(np.float64), 3)
+    for start in range(0, len(self), chunk_size):
+      stop = min(start+chunk_size, len(self))
+      rows = np.empty((stop-start, 7), dtype=object)
+      rows[:, 0] = files[self.columns['file'][start:stop]]
+      for k, name in enumerate(self.INT_COLUMNS + ['classid']):
+        rows[:, k+1] = self.columns[name][start:stop].tolist()
+      rows[:, 6] = score[start:stop].tolist()
+      yield ("['%s', %d, %d, %d, %d, %d, %r],\n"*(stop-start)) % tuple(rows.ravel().tolist())
+
+  def to_labels_js(self, path):
+    # the label table of the browser viewer
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+      f.write('var  labels  =  [' + '\n')
+      for rows in self.labels_js_rows():
+        f.write(rows)
+      f.write('];' + '\n')
+
+class ResultCache:
+  """
+  On-disk cache of cleaned label tables, and optionally the linear and rainbow PNGs, keyed by the
+  audio content hash, the weights hash and the detection parameters. Content hashes are memoized
+  on path, size and mtime, so unchanged recordings are recognised without being read again.
+  The least recently used entries are evicted once the cache grows beyond max_size bytes.
+  """
+  def __init__(self, cache_path='silic_cache', max_size=2*1024**3, save_images=True):
+    self.cache_path = cache_path
+    self.max_size = max_size
+    self.save_images = save_images
+    if not os.path.isdir(cache_path):
+      os.makedirs(cache_path)
+    self.index_file = os.path.join(cache_path, 'hashes.json')
+    self.hashes = {}
+    if os.path.isfile(self.index_file):
+      with open(self.index_file, encoding='utf-8') as f:
+        self.hashes = json.load(f)
+    self.size = sum(self.entry_size(entry) for entry in self.entries())
+
+  def entries(self):
+    return [os.path.join(self.cache_path, name) for name in os.listdir(self.cache_path) if os.path.isdir(os.path.join(self.cache_path, name))]
+
+  def entry_size(self, entry):
+    return sum(os.path.getsize(os.path.join(dirpath, name)) for dirpath, dirnames, filenames in os.walk(entry) for name in filenames)
+
+  def file_hash(self, path):
+    stat = os.stat(path)
+    memo = self.hashes.get(os.path.abspath(path))
+    if memo and memo[0] == stat.st_size and memo[1] == stat.st_mtime_ns:
+      return memo[2]
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+      for block in iter(lambda: f.read(1 << 20), b''):
+        h.update(block)
+    self.hashes[os.path.abspath(path)] = [stat.st_size, stat.st_mtime_ns, h.hexdigest()]
+    return h.hexdigest()
+
+  def key(self, audiofile, weights, params):
+    h = hashlib.sha1()
+    h.update(self.file_hash(audiofile).encode())
+    h.update(self.file_hash(weights).encode())
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+  def get(self, key):
+    # cleaned labels of a cached recording (empty when no sound was found), None on a miss
+    entry = os.path.join(self.cache_path, key)
+    if not os.path.isfile(os.path.join(entry, 'labels.csv')):
+      return None
+    os.utime(entry)
+    return pd.read_csv(os.path.join(entry, 'labels.csv'), encoding='utf8')
+
+  def restore(self, key, name, targetfilepath):
+    # an image, or a folder of spectrogram tiles
+    cached = os.path.join(self.cache_path, key, name)
+    if os.path.isdir(cached):
+      shutil.copytree(cached, targetfilepath, dirs_exist_ok=True)
+    elif os.path.isfile(cached):
+      shutil.copyfile(cached, targetfilepath)
+    else:
+      return False
+    return True
+
+  def put(self, key, labels, images={}):
+    entry = os.path.join(self.cache_path, key)
+    if not os.path.isdir(entry):
+      os.mkdir(entry)
+    self.size -= self.entry_size(entry)
+    if self.save_images:
+      for name, path in images.items():
+        if os.path.isdir(path):
+          shutil.copytree(path, os.path.join(entry, name), dirs_exist_ok=True)
+        elif os.path.isfile(path):
+          shutil.copyfile(path, os.path.join(entry, name))
+    # labels.csv marks a complete entry, so it is written last and atomically
+    labels.to_csv(os.path.join(entry, 'labels.tmp'), index=False)
+    os.replace(os.path.join(entry, 'labels.tmp'), os.path.join(entry, 'labels.csv'))
+    self.size += self.entry_size(entry)
+    self.evict()
+
+  def evict(self):
+    if self.size <= self.max_size:
+      return
+    for entry in sorted(self.entries(), key=os.path.getmtime):
+      self.size -= self.entry_size(entry)
+      shutil.rmtree(entry, ignore_errors=True)
+      if self.size <= self.max_size:
+        break
+
+  def save(self):
+    with open(self.index_file, 'w', encoding='utf-8') as f:
+      json.dump(self.hashes, f)
+
+class BrowserPackage:
+  """
+  Output stage of browser(). js/labels.js and js/soundclass.js grow by one recording at a time,
+  and with archive the outputs of every recording are added to the zip as soon as they are
+  written, so nothing is formatted or read back at the end. PNG, JPG and MP3 files are already
+  compressed and are stored as they are unless compress_images. The manifests of spectrogram
+  tile folders are collected in js/tiles.js for the viewer.
+  """
+  STORED_EXTENSIONS = ['png', 'jpg', 'mp3']
+
+  def __init__(self, result_path, soundclasses, targetclasses=None, archive=None, compress_images=False):
+    self.result_path = result_path
+    self.soundclasses = soundclasses.set_index('sounclass_id')
+    self.targetclasses = targetclasses
+    self.compress_images = compress_images
+    self.classes = set()
+    self.labels_js = open(os.path.join(result_path, 'js', 'labels.js'), 'w', newline='', encoding='utf-8')
+    self.labels_js.write('var  labels  =  [' + '\n')
+    self.soundclass_js = open(os.path.join(result_path, 'js', 'soundclass.js'), 'w', newline='', encoding='utf-8')
+    self.soundclass_js.write('var sounds = { \n')
+    self.tiles_js = open(os.path.join(result_path, 'js', 'tiles.js'), 'w', newline='', encoding='utf-8')
+    self.tiles_js.write('var tiles = {};\n')
+    if targetclasses:
+      self.add_classes(targetclasses)
+    self.archive_path = os.path.abspath(archive) if archive else None
+    self.zip = zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) if archive else None
+    self.archived = set()
+
+  def add_classes(self, classids):
+    classids = [classid for classid in classids if classid not in self.classes and classid in self.soundclasses.index]
+    rows = self.soundclasses.loc[classids]
+    self.soundclass_js.write(''.join('"%s": ["%s", "%s", "%s"], \n' %row for row in zip(rows.index, rows['species_name'], rows['sound_class'], rows['scientific_name'])))
+    self.classes.update(classids)
+
+  def add(self, labels, paths=[]):
+    # labels (LabelStore or None) of one recording and the files written for it
+    if labels is not None and len(labels):
+      for rows in labels.labels_js_rows():
+        self.labels_js.write(rows)
+      if not self.targetclasses:
+        self.add_classes(labels.classids().tolist())
+      self.labels_js.flush()
+      self.soundclass_js.flush()
+    for path in paths:
+      if os.path.isfile(os.path.join(path, 'manifest.json')):
+        with open(os.path.join(path, 'manifest.json'), encoding='utf-8') as f:
+          manifest = f.read()
+        self.tiles_js.write('tiles["%s"] = %s;\n' %(os.path.relpath(path, self.result_path).replace(os.sep, '/'), manifest))
+        self.tiles_js.flush()
+      self.archive(path)
+
+  def archive(self, path):
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+      for dirpath, dirnames, filenames in os.walk(path):
+        for filename in sorted(filenames):
+          self.archive(os.path.join(dirpath, filename))
+      return
+    if not self.zip or path in self.archived or path == self.archive_path or not os.path.isfile(path):
+      return
+    stored = path.split('.')[-1].lower() in self.STORED_EXTENSIONS and not self.compress_images
+    self.zip.write(path, os.path.relpath(path, os.path.abspath(self.result_path)), compress_type=zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED)
+    self.archived.add(path)
+
+  def close(self):
+    # finish both scripts and archive whatever was not added with a recording (index.html, js, labels.csv, ...)
+    self.labels_js.write('];' + '\n')
+    self.labels_js.close()
+    self.soundclass_js.write('};')
+    self.soundclass_js.close()
+    self.tiles_js.close()
+    if self.zip:
+      for dirpath, dirnames, filenames in os.walk(self.result_path):
+        for filename in sorted(filenames):
+          self.archive(os.path.join(dirpath, filename))
+      self.zip.close()
+
+worker_silic = None
+
+def prepare_audio(audiofile, linear_file, rainbow_file, silic_kwargs, prescreen=False, tiles=False):
+  # decode and spectrogram stage of batch_detect, runs in a worker process on CPU
+  global worker_silic
+  if worker_silic is None:
+    torch.set_num_threads(1)
+    worker_silic = SilicBat(device='cpu', **silic_kwargs)
+  silic = worker_silic
+  silic.audio(audiofile)
+  silic.tfr(targetfilepath=linear_file, tiles=tiles)
+  silic.tfr(targetfilepath=rainbow_file, spect_type='rainbow', tiles=tiles)
+  if prescreen:
+    silic.activity()
+  silic.free_spectrograms()
+  return {'frame_activity':silic.frame_activity, 'audiofilename':silic.audiofilename, 'audiofilename_without_ext':silic.audiofilename_without_ext, 'audiopath':silic.audiopath, 'audiofileext':silic.audiofileext, 'duration':silic.duration, 'rainbow_img':silic.rainbow_img}
+
+def serial_detect(model, audiofiles, weights, linear_path, rainbow_path, stream_window=None, tiles=False, **kwargs):
+  # yields (audiofile, labels) one file after another
+  for audiofile in audiofiles:
+    if stream_window:
+      # the windows are written into one tile pyramid per recording, like tiles
+      labels = model.detect_stream(audiofile, weights=weights, window=stream_window, targetpath=rainbow_path, linearpath=linear_path, **kwargs)
+    else:
+      model.audio(audiofile)
+      model.tfr(targetfilepath=os.path.join(linear_path, model.audiofilename_without_ext+'.png'), tiles=tiles)
+      labels = model.detect(weights=weights, targetfilepath=os.path.join(rainbow_path, model.audiofilename_without_ext+'.png'), tiles=tiles, **kwargs)
+      model.free_spectrograms()
+    yield audiofile, labels
+
+def batch_detect(model, audiofiles, weights, linear_path, rainbow_path, decode_workers=2, tiles=False, **kwargs):
+  """
+  Pipelined counterpart of serial_detect. Decoding and spectrogram rendering run in a pool of
+  decode_workers processes while the calling process, which owns the loaded model, runs inference
+  on the files already prepared. Results are yielded in the order of audiofiles.
+  """
+  model.load_model(weights)
+  silic_kwargs = {'sr':model.sr, 'n_fft':model.n_fft, 'hop_length':model.hop_length, 'n_mels':model.n_mels, 'fmin':model.fmin, 'fmax':model.fmax, 'clip_length':model.clip_length, 'spect_engine':model.spect_engine, 'audio_backend':model.audio_backend}
+  with ProcessPoolExecutor(max_workers=decode_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+    pending = []
+    files = iter(audiofiles)
+    while True:
+      # keep at most two files per worker in flight so memory stays bounded
+      for audiofile in files:
+        name = os.path.splitext(os.path.basename(audiofile))[0]
+        pending.append((audiofile, pool.submit(prepare_audio, audiofile, os.path.join(linear_path, name+'.png'), os.path.join(rainbow_path, name+'.png'), silic_kwargs, kwargs.get('prescreen') is not None and kwargs.get('prescreen') is not False, tiles)))
+        if len(pending) >= decode_workers*2:
+          break
+      if not pending:
+        break
+      audiofile, future = pending.pop(0)
+      model.__dict__.update(future.result())
+      profiler.count('audio_seconds', model.duration/1000)
+      yield audiofile, model.detect_clips(**kwargs)
+
+def write_labels(audiofile, labels, audio_path, lable_path, cache=None, key=None, images={}, package=None):
+  # writer stage: copy the recording and save its cleaned labels, labels is either the raw
+  # output of detect or an already cleaned table restored from the cache
+  audiofilename = os.path.basename(audiofile)
+  paths = list(images.values())
+  if audio_path:
+    shutil.copyfile(audiofile, os.path.join(audio_path, audiofilename))
+    paths.append(os.path.join(audio_path, audiofilename))
+    #model.save_standarized(targetmp3path=os.path.join(audio_path, model.audiofilename.replace('.wav','.mp3').replace('.WAV','.mp3')))
+  if isinstance(labels, pd.DataFrame):
+    newlabels = labels
+  elif len(labels) == 1:
+    newlabels = pd.DataFrame(columns=labels[0])
+  else:
+    with profiler.stage('clean'):
+      newlabels = clean_multi_boxes(labels)
+  if cache and key:
+    cache.put(key, newlabels, images)
+  store = None
+  if newlabels.shape[0] == 0:
+    print("No sound found in %s." %audiofile)
+  else:
+    newlabels['file'] = audiofilename
+    with profiler.stage('output'):
+      newlabels.to_csv(os.path.join(lable_path, os.path.splitext(audiofilename)[0]+'.csv'), index=False)
+    paths.append(os.path.join(lable_path, os.path.splitext(audiofilename)[0]+'.csv'))
+    print("%s sounds of %s species is/are found in %s" %(newlabels.shape[0], len(newlabels['classid'].unique()), audiofile))
+    store = LabelStore.from_frame(newlabels)
+  if package:
+    with profiler.stage('output'):
+      package.add(store, paths)
+  return store
+
+def browser(audiosource, weights='model/exp/best.pt', step=100, targetclasses=[], conf_thres=0.1, savepath=None, zip=True, batch_size=None, stream_window=None, decode_workers=0, model=None, cache=None, tiling=False, profile=None, prescreen=None, compress_images=False, tiles=False, class_bands=False, band_crop=False):
   t0 = time.time()
+  if profile:
+    profiler.enable()
   # init
   if savepath and os.path.isdir(savepath):
     result_path = savepath
@@ -452,9 +1815,8 @@ def browser(audiosource, weights='model/exp/best.pt', step=100, targetclasses=[]
   if not os.path.isdir(js_path):
     os.mkdir(js_path)
   shutil.copyfile('browser/index.html', os.path.join(result_path, 'index.html'))
-  all_labels = pd.DataFrame()
-  model = SilicBat()
-  audiofile = None
+  if not model:
+    model = SilicBat()
   if os.path.isfile(audiosource):
     sourthpath = ''
     audiofiles = [audiosource]
@@ -465,64 +1827,262 @@ def browser(audiosource, weights='model/exp/best.pt', step=100, targetclasses=[]
   else:
     print('Files not found')
     exit()
-  i = 0
-  for audiofile in audiofiles:
-    audiofile = os.path.join(sourthpath, audiofile)
-    if not audiofile.split('.')[-1].lower() in ['mp3', 'wma', 'm4a', 'ogg', 'wav', 'mp4', 'wma', 'aac']:
-      continue
-    model.audio(audiofile)
-    i += 1
-    if audio_path:
-      shutil.copyfile(audiofile, os.path.join(audio_path, model.audiofilename))
-      #model.save_standarized(targetmp3path=os.path.join(audio_path, model.audiofilename.replace('.wav','.mp3').replace('.WAV','.mp3')))
-    model.tfr(targetfilepath=os.path.join(linear_path, model.audiofilename_without_ext+'.png'))
-    labels = model.detect(weights=weights, step=step, targetclasses=targetclasses, conf_thres=conf_thres, targetfilepath=os.path.join(rainbow_path, model.audiofilename_without_ext+'.png'))
-    if len(labels) == 1:
-      print("No sound found in %s." %audiofile)
-    else:
-      newlabels = clean_multi_boxes(labels)
-      newlabels['file'] = model.audiofilename
-      newlabels.to_csv(os.path.join(lable_path, model.audiofilename_without_ext+'.csv'), index=False)
-      if all_labels.shape[0] > 0:
-        all_labels = all_labels.append(newlabels, ignore_index = True)
+  audiofiles = [os.path.join(sourthpath, audiofile) for audiofile in audiofiles if audiofile.split('.')[-1].lower() in AUDIO_EXTENSIONS]
+  i = len(audiofiles)
+  detect_kwargs = {'step':step, 'targetclasses':targetclasses, 'conf_thres':conf_thres, 'batch_size':batch_size, 'tiling':tiling, 'prescreen':prescreen, 'class_bands':class_bands, 'band_crop':band_crop}
+  if cache and not isinstance(cache, ResultCache):
+    cache = ResultCache(cache)
+  keys = {}
+  cached = {}
+  if cache:
+    params = {'step':step, 'conf_thres':conf_thres, 'targetclasses':sorted(targetclasses) if targetclasses else [], 'stream_window':stream_window, 'tiling':tiling, 'prescreen':prescreen, 'tiles':tiles, 'class_bands':class_bands, 'band_crop':band_crop}
+    # the model configuration changes the labels as much as the detection options do
+    for name in ['sr', 'n_fft', 'hop_length', 'n_mels', 'fmin', 'fmax', 'clip_length', 'spect_engine', 'audio_backend', 'inference_backend', 'quantize']:
+      params[name] = getattr(model, name)
+    for audiofile in audiofiles:
+      keys[audiofile] = cache.key(audiofile, weights, params)
+      labels = cache.get(keys[audiofile])
+      if labels is not None:
+        name = os.path.splitext(os.path.basename(audiofile))[0]
+        if tiles or stream_window:
+          cache.restore(keys[audiofile], 'linear', os.path.join(linear_path, name))
+          cache.restore(keys[audiofile], 'rainbow', os.path.join(rainbow_path, name))
+        else:
+          cache.restore(keys[audiofile], 'linear.png', os.path.join(linear_path, name+'.png'))
+          cache.restore(keys[audiofile], 'rainbow.png', os.path.join(rainbow_path, name+'.png'))
+        cached[audiofile] = labels
+    print('%s of %s recording(s) found in the cache.' %(len(cached), len(audiofiles)))
+  misses = [audiofile for audiofile in audiofiles if audiofile not in cached]
+  if decode_workers and not stream_window:
+    detections = batch_detect(model, misses, weights, linear_path, rainbow_path, decode_workers=decode_workers, tiles=tiles, **detect_kwargs)
+  else:
+    # streamed recordings are always written as tile pyramids
+    detections = serial_detect(model, misses, weights, linear_path, rainbow_path, stream_window=stream_window, tiles=tiles and not stream_window, **detect_kwargs)
+  package = BrowserPackage(result_path, model.registry.soundclasses(weights), targetclasses=targetclasses, archive='result_silic.zip' if zip else None, compress_images=compress_images)
+  written = {}
+  with ThreadPoolExecutor(max_workers=1) as writer:
+    # files are written in the order of audiofiles, so labels.js keeps that order
+    for audiofile in audiofiles:
+      name = os.path.splitext(os.path.basename(audiofile))[0]
+      if tiles or stream_window:
+        images = {'linear':os.path.join(linear_path, name), 'rainbow':os.path.join(rainbow_path, name)}
       else:
-        all_labels = newlabels
-      print("%s sounds of %s species is/are found in %s" %(newlabels.shape[0], len(newlabels['classid'].unique()), audiofile))
+        images = {'linear.png':os.path.join(linear_path, name+'.png'), 'rainbow.png':os.path.join(rainbow_path, name+'.png')}
+      if audiofile in cached:
+        written[audiofile] = writer.submit(write_labels, audiofile, cached[audiofile], audio_path, lable_path, images=images, package=package)
+      else:
+        _, labels = next(detections)
+        written[audiofile] = writer.submit(write_labels, audiofile, labels, audio_path, lable_path, cache, keys.get(audiofile), images, package)
+  if cache:
+    cache.save()
+  all_labels = LabelStore.concat([written[audiofile].result() for audiofile in audiofiles])
 
-  if all_labels.shape[0] == 0:
+  if len(all_labels) == 0:
     print('No sounds found!')
   else:
-    all_labels.to_csv(os.path.join(lable_path, 'labels.csv'), index=False)
-    print('%s sounds of %s species is/are found in %s recording(s). Preparing the browser package ...' %(all_labels.shape[0], len(all_labels['classid'].unique()), i))
-    df_classes = pd.read_csv(weights.replace('best.pt', 'soundclasses.csv'))
-    if targetclasses:
-      df_classes = df_classes[df_classes['sounclass_id'].isin(targetclasses)]
-    else:
-      names = all_labels['classid'].unique()
-      df_classes = df_classes[df_classes['sounclass_id'].isin(names)]
-    with open(os.path.join(js_path, 'soundclass.js'), 'w', newline='', encoding='utf-8') as csv_file:
-      csv_file.write('var sounds = { \n')
-      for index, row in df_classes.iterrows():
-        csv_file.write('"%s": ["%s", "%s", "%s"], \n' %(row['sounclass_id'], row['species_name'], row['sound_class'], row['scientific_name']))
-      csv_file.write('};')
-
-    with open(os.path.join(js_path, 'labels.js'), 'w', newline='', encoding='utf-8') as f:
-      f.write('var  labels  =  [' + '\n')
-      for index, label in all_labels.iterrows():
-        f.write("['{}', {}, {}, {}, {}, {}, {}],\n".format(label['file'], label['time_begin'], label['time_end'], label['freq_low'], label['freq_high'], label['classid'], label['score']))
-      f.write('];' + '\n')
-    
+    with profiler.stage('output'):
+      all_labels.to_csv(os.path.join(lable_path, 'labels.csv'))
+    print('%s sounds of %s species is/are found in %s recording(s). Preparing the browser package ...' %(len(all_labels), len(all_labels.classids()), i))
+  with profiler.stage('output'):
+    package.close()
+  if len(all_labels):
     if zip:
-        shutil.make_archive('result_silic', 'zip', result_path)
-        print('Finished. The browser package is compressed and named result.zip')
+        print('Finished. The browser package is compressed and named result_silic.zip')
     else:
         print('Finished. All results were saved in the folder %s' %result_path)
     print(time.time()-t0, 'used.')
+  if profile:
+    profiler.report(profile, audiosource=audiosource, recordings=i, step=step, conf_thres=conf_thres, batch_size=batch_size, stream_window=stream_window, decode_workers=decode_workers, tiling=tiling, prescreen=prescreen, tiles=tiles, class_bands=class_bands, band_crop=band_crop, device=model.device)
+    profiler.disable()
+
+class SilicService:
+  """
+  Long-running ingestion of a spool folder that recorders keep writing to. One warm SilicBat per
+  worker (sharing the registry, so the model is loaded once) processes the recordings of a bounded
+  queue; the poller only queues a file after its size and mtime have not changed for settle
+  seconds, and blocks while the queue is full. A cleaned label CSV per recording is written
+  atomically to output_path, mirroring the spool folder, so files whose CSV is newer than the
+  audio are skipped after a restart. stats() and output_path/status.json report the queue depth
+  and the latency from queueing to the written CSV.
+  """
+  def __init__(self, spool_path, output_path='result_silic', weights='model/exp/best.pt', workers=1, max_queue=16, poll_interval=5, settle=2, save_images=False, silic_kwargs={}, **detect_kwargs):
+    self.spool_path = spool_path
+    self.output_path = output_path
+    self.weights = weights
+    self.poll_interval = poll_interval
+    self.settle = settle
+    self.save_images = save_images
+    self.detect_kwargs = detect_kwargs
+    self.queue = queue.Queue(maxsize=max_queue)
+    self.stop_event = threading.Event()
+    self.lock = threading.Lock()
+    self.pending = {}  # path: (size, mtime) at the last poll, waiting to settle
+    self.seen = {}     # path: (size, mtime) while queued or after failing; done files are recognized by their CSV
+    self.in_flight = 0
+    self.counters = {'queued':0, 'processed':0, 'failed':0, 'detections':0}
+    self.latencies = collections.deque(maxlen=1000)   # seconds from queueing to the written CSV
+    self.processing = collections.deque(maxlen=1000)  # seconds of decoding and detection
+    self.threads = []
+    os.makedirs(output_path, exist_ok=True)
+    self.models = []
+    for _ in range(max(1, workers)):
+      silic = SilicBat(**silic_kwargs)
+      silic.load_model(weights)
+      self.models.append(silic)
+
+  def output_file(self, audiofile):
+    return os.path.join(self.output_path, os.path.splitext(os.path.relpath(audiofile, self.spool_path))[0]+'.csv')
+
+  def scan(self):
+    # one poll of the spool folder, returns the new recordings that have settled;
+    # seen and pending are shared with the workers, so they are only used under the lock
+    ready = []
+    found = {}
+    now = time.time()
+    for dirpath, dirnames, filenames in os.walk(self.spool_path):
+      for filename in sorted(filenames):
+        if filename.split('.')[-1].lower() not in AUDIO_EXTENSIONS:
+          continue
+        audiofile = os.path.join(dirpath, filename)
+        try:
+          stat = os.stat(audiofile)
+        except OSError:
+          continue
+        found[audiofile] = stat
+    for audiofile, stat in found.items():
+      signature = (stat.st_size, stat.st_mtime_ns)
+      with self.lock:
+        if self.seen.get(audiofile) == signature:
+          continue
+      output = self.output_file(audiofile)
+      if os.path.isfile(output) and os.path.getmtime(output) >= stat.st_mtime:
+        continue
+      with self.lock:
+        if self.pending.get(audiofile) == signature and now - stat.st_mtime >= self.settle:
+          del self.pending[audiofile]
+          self.seen[audiofile] = signature
+          ready.append(audiofile)
+        else:
+          self.pending[audiofile] = signature
+    # forget recordings that left the spool folder
+    with self.lock:
+      for tracked in [self.pending, self.seen]:
+        for audiofile in [audiofile for audiofile in tracked if audiofile not in found]:
+          del tracked[audiofile]
+    return ready
+
+  def poll(self):
+    while not self.stop_event.is_set():
+      try:
+        for audiofile in self.scan():
+          while not self.stop_event.is_set():
+            try:
+              self.queue.put((audiofile, time.time()), timeout=1)  # backpressure: wait for a free slot
+            except queue.Full:
+              continue
+            with self.lock:
+              self.counters['queued'] += 1
+            break
+      except Exception as e:
+        # a failed poll must not stop the service, the next one retries
+        print('Failed to poll %s: %s' %(self.spool_path, e))
+      self.stop_event.wait(self.poll_interval)
+
+  def work(self, silic):
+    while not self.stop_event.is_set() or not self.queue.empty():
+      try:
+        audiofile, queued = self.queue.get(timeout=1)
+      except queue.Empty:
+        continue
+      with self.lock:
+        self.in_flight += 1
+      t0 = time.time()
+      try:
+        n = self.process(silic, audiofile)
+        with self.lock:
+          self.seen.pop(audiofile, None)  # its CSV marks it as done from now on
+          self.counters['processed'] += 1
+          self.counters['detections'] += n
+          self.latencies.append(time.time() - queued)
+          self.processing.append(time.time() - t0)
+      except (Exception, SystemExit) as e:
+        print('Failed to process %s: %s' %(audiofile, e))
+        with self.lock:
+          self.counters['failed'] += 1
+      finally:
+        with self.lock:
+          self.in_flight -= 1
+        self.queue.task_done()
+
+  def process(self, silic, audiofile):
+    output = self.output_file(audiofile)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    silic.audio(audiofile)
+    labels = silic.detect(self.weights, targetfilepath=os.path.splitext(output)[0]+'.png', save=self.save_images, **self.detect_kwargs)
+    silic.free_spectrograms()
+    newlabels = clean_multi_boxes(labels) if len(labels) > 1 else pd.DataFrame(columns=LABEL_COLUMNS)
+    newlabels['file'] = os.path.relpath(audiofile, self.spool_path)
+    # an interrupted write never leaves a partial CSV behind
+    newlabels.to_csv(output+'.tmp', index=False)
+    os.replace(output+'.tmp', output)
+    return newlabels.shape[0]
+
+  def stats(self):
+    with self.lock:
+      last = self.latencies[-1] if self.latencies else None
+      latencies = sorted(self.latencies)
+      processing = list(self.processing)
+      stats = dict(self.counters, queue_depth=self.queue.qsize(), in_flight=self.in_flight, settling=len(self.pending))
+    stats['latency_last'] = last
+    stats['latency_mean'] = sum(latencies)/len(latencies) if latencies else None
+    stats['latency_p95'] = latencies[max(0, math.ceil(0.95*len(latencies))-1)] if latencies else None  # nearest rank
+    stats['latency_max'] = latencies[-1] if latencies else None
+    stats['processing_mean'] = sum(processing)/len(processing) if processing else None
+    return stats
+
+  def write_status(self):
+    status = os.path.join(self.output_path, 'status.json')
+    with open(status+'.tmp', 'w', encoding='utf-8') as f:
+      json.dump(dict(self.stats(), time=time.strftime('%Y-%m-%dT%H:%M:%S')), f, indent=2)
+    os.replace(status+'.tmp', status)
+
+  def start(self):
+    self.stop_event.clear()
+    self.threads = [threading.Thread(target=self.poll, daemon=True)]
+    self.threads += [threading.Thread(target=self.work, args=(silic,), daemon=True) for silic in self.models]
+    for thread in self.threads:
+      thread.start()
+
+  def stop(self):
+    # stop polling, finish the queued recordings and wait for the workers
+    self.stop_event.set()
+    for thread in self.threads:
+      thread.join()
+    self.write_status()
+
+  def run(self, duration=None):
+    # serve until interrupted (or for duration seconds), updating status.json every poll
+    print('Watching %s, writing labels to %s.' %(self.spool_path, self.output_path))
+    self.start()
+    t0 = time.time()
+    try:
+      while duration is None or time.time() - t0 < duration:
+        time.sleep(self.poll_interval)
+        self.write_status()
+    except KeyboardInterrupt:
+      pass
+    self.stop()
+    print(self.stats())
 
 if __name__ == '__main__':
+  if sys.argv[1] == 'serve':
+    # python silicbat.py serve <spool folder> [<output folder>]
+    SilicService(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else 'result_silic').run()
+    sys.exit()
   mainpath = sys.argv[1]
+  model = SilicBat()
   if os.path.isfile(mainpath):
-    browser(mainpath, zip=False)
+    browser(mainpath, zip=False, model=model)
   else:
     i = 0
     for dirPath, dirNames, fileNames in os.walk(mainpath):
@@ -530,5 +2090,5 @@ if __name__ == '__main__':
         savepath = os.path.join('result_%s_%s'%(i,dir))
         if not os.path.isdir(savepath):
           os.mkdir(savepath)
-        browser(os.path.join(dirPath,dir), savepath=savepath, zip=False)
+        browser(os.path.join(dirPath,dir), savepath=savepath, zip=False, model=model)
         i += 1